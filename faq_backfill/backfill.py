@@ -0,0 +1,428 @@
+import os
+import sys
+import time
+import bisect
+import argparse
+
+# --- 必要的套件引入 ---
+from dotenv import load_dotenv
+import numpy as np
+
+# 【語言偵測】請執行 pip install langdetect；未安裝時語言一致性檢查 (過濾邏輯 4) 會停用，並在開始回填時提出警告
+try:
+    from langdetect import detect, LangDetectException
+except ImportError:
+    detect = None
+
+# 讓 Python 找到上一層的 faq_backfill 套件 (直接執行本檔案時)
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from faq_backfill.dedup_index import FaqDedupIndex, MATCH_THRESHOLD
+
+# --- 設定區 ---
+HISTORY_TABLE = os.getenv("HISTORY_TABLE", "taipei_marathon_history")  # 請改成歷史紀錄 table 的名稱
+BATCH_SIZE = 500                 # 每批處理的 chatbot 回應筆數
+PREVIOUS_MESSAGE_WINDOW = 20     # 查詢上一句時，往每段區間最小 id 之前多抓的筆數
+MAX_RUN_GAP = 20                 # 相鄰兩筆回應的 id 相差超過此值時，拆成不同區間查詢上一句 (避免區間涵蓋大量已處理的紀錄)
+WINDOW_PAGE_SIZE = 1000          # 查詢上一句時每頁的筆數 (PostgREST 預設單次最多回傳 1000 筆)
+IN_FILTER_CHUNK_SIZE = 100       # 每次 in_ 篩選最多帶入的值數量，避免網址過長
+EMBEDDING_MODEL = "text-embedding-3-large"
+EMBEDDING_DIMENSIONS = 1536
+EMBEDDING_MAX_INPUTS = 2048      # OpenAI 單次 embeddings 請求的輸入上限
+MAX_BATCH_ATTEMPTS = 3           # 同一批連續失敗幾次後，改為切分批次找出造成失敗的紀錄
+MAX_ISOLATED_FAILURES = 10       # 切分批次時，失敗的紀錄超過此筆數即視為系統性錯誤 (例如無法連線)，不再略過
+RETRY_SLEEP_SECONDS = 5          # 批次失敗後重試前的休息秒數
+IDLE_SLEEP_SECONDS = 2           # 持續監看模式下，沒有資料時的初始休息秒數
+MAX_IDLE_SLEEP_SECONDS = 60      # 沒有資料時休息秒數的上限 (逐次加倍)
+
+def initialize_clients():
+    """載入環境變數並初始化 Supabase 與 OpenAI 客戶端。"""
+    load_dotenv()
+    supabase_url = os.getenv("SUPABASE_URL")
+    supabase_key = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+    openai_api_key = os.getenv("OPENAI_API_KEY")
+    if not supabase_url or not supabase_key or not openai_api_key:
+        print("❌ 錯誤：找不到 SUPABASE_URL、SUPABASE_SERVICE_ROLE_KEY 或 OPENAI_API_KEY。請檢查您的 .env 檔案。")
+        return None, None
+    try:
+        from supabase import create_client
+        from openai import OpenAI
+        supabase = create_client(supabase_url, supabase_key)
+        openai_client = OpenAI(api_key=openai_api_key)
+        print("✅ Supabase 與 OpenAI 客戶端初始化成功。")
+        return supabase, openai_client
+    except Exception as e:
+        print(f"❌ 初始化客戶端時發生錯誤：{e}")
+        return None, None
+
+def get_language_code(text):
+    """取得正規化後的語言代碼，例如 'zh-tw' -> 'zh'，確保繁簡中都被視為中文。"""
+    if detect is None:
+        return "unknown"
+    try:
+        return detect(text).split('-')[0].lower()
+    except LangDetectException:
+        return "unknown"
+
+def clean_question(user_msg):
+    """去除前端自動加上的前後綴，取得使用者實際的問題。"""
+    return user_msg.replace("關於台北馬拉松所有賽事有些相關問題想請教，", "")\
+                   .replace("，請翻閱知識庫回答。", "")\
+                   .strip()
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def fetch_unprocessed_bot_logs(supabase, batch_size=BATCH_SIZE):
+    """抓取一批尚未處理的 chatbot 回應 (依 id 排序)。"""
+    response = supabase.table(HISTORY_TABLE)\
+        .select("id, who, message")\
+        .eq("who", "chatbot")\
+        .eq("is_processed", False)\
+        .order("id")\
+        .limit(batch_size)\
+        .execute()
+    return response.data or []
+
+def fetch_message_window(supabase, start_id, end_id):
+    """
+    分頁取回 id 介於 [start_id, end_id] 的所有紀錄 (依 id 排序)。
+    以「上一頁最後的 id」接續查詢，即使伺服器的單次回傳上限小於 WINDOW_PAGE_SIZE 也不會漏掉資料。
+    """
+    rows = []
+    next_id = start_id
+    while True:
+        response = supabase.table(HISTORY_TABLE)\
+            .select("id, who, message")\
+            .gte("id", next_id)\
+            .lte("id", end_id)\
+            .order("id")\
+            .limit(WINDOW_PAGE_SIZE)\
+            .execute()
+        page = response.data or []
+        rows.extend(page)
+        if not page or page[-1]["id"] >= end_id:
+            return rows
+        next_id = page[-1]["id"] + 1
+
+def fetch_previous_message(supabase, log_id):
+    """個別查詢單筆回應的上一筆紀錄 (沒有則回傳 None)。"""
+    response = supabase.table(HISTORY_TABLE)\
+        .select("id, who, message")\
+        .lt("id", log_id)\
+        .order("id", desc=True)\
+        .limit(1)\
+        .execute()
+    return response.data[0] if response.data else None
+
+def split_into_runs(log_ids, max_gap=MAX_RUN_GAP):
+    """將排序後的 id 依間距拆成數段連續區間，相鄰 id 相差超過 max_gap 即另起一段。"""
+    runs = []
+    for log_id in log_ids:
+        if runs and log_id - runs[-1][-1] <= max_gap:
+            runs[-1].append(log_id)
+        else:
+            runs.append([log_id])
+    return runs
+
+def fetch_previous_messages(supabase, logs):
+    """
+    取回整批回應的「上一句」，回傳 {回應 id: 上一筆紀錄或 None}。
+    先將回應 id 拆成數段連續區間 (持續監看模式下未處理的回應常是零散的少數幾筆，
+    若以整批最小與最大 id 查詢，區間會涵蓋大量已處理的紀錄)：
+    只有一筆的區間直接個別查詢；其餘以 [區間最小 id - PREVIOUS_MESSAGE_WINDOW, 區間最大 id] 分頁取回，
+    只有在區間中找到該回應、且它前面還有紀錄時，才採用區間內的上一筆，
+    其餘情況 (例如中間有大量被刪除的 id，或區間不完整) 才對該筆個別查詢。
+    """
+    previous_by_id = {}
+    for run in split_into_runs(sorted(log["id"] for log in logs)):
+        if len(run) == 1:
+            previous_by_id[run[0]] = fetch_previous_message(supabase, run[0])
+            continue
+        window_rows = fetch_message_window(supabase, run[0] - PREVIOUS_MESSAGE_WINDOW, run[-1])
+        window_ids = [row["id"] for row in window_rows]
+        for log_id in run:
+            position = bisect.bisect_left(window_ids, log_id)
+            covered = position < len(window_ids) and window_ids[position] == log_id
+            if covered and position > 0:
+                previous_by_id[log_id] = window_rows[position - 1]
+            else:
+                previous_by_id[log_id] = fetch_previous_message(supabase, log_id)
+    return previous_by_id
+
+def build_candidates(logs, previous_by_id):
+    """套用原本逐筆處理時的過濾規則，回傳可寫入 FAQ 的候選問答 (同一批內相同的問題只保留第一筆)。"""
+    candidates = []
+    seen_questions = set()
+    for log in logs:
+        current_id = log["id"]
+        bot_msg = log.get("message")
+
+        # 【過濾邏輯 1】如果是 NULL 或空字串，直接跳過
+        if not bot_msg or len(bot_msg.strip()) == 0:
+            print(f"ID {current_id}: Skipped (Empty bot response)")
+            continue
+
+        prev_msg = previous_by_id.get(current_id)
+        if not prev_msg or prev_msg.get("who") != "people":
+            print(f"ID {current_id}: Skipped (No matching user question)")
+            continue
+
+        # 【過濾邏輯 2】如果使用者的問題是空的，也跳過
+        user_msg = prev_msg.get("message")
+        if not user_msg or len(user_msg.strip()) == 0:
+            print(f"ID {current_id}: Skipped (Empty user question)")
+            continue
+
+        # 【過濾邏輯 3】檢查內容有效性 (長度 & 排除錯誤訊息)
+        clean_q = clean_question(user_msg)
+        if len(clean_q) <= 1 or "無法提供回覆" in bot_msg or "沒有直接關聯" in bot_msg:
+            print(f"ID {current_id}: Skipped (Invalid content or error message)")
+            continue
+
+        # 【過濾邏輯 4】語言一致性檢查
+        lang_q = get_language_code(clean_q)
+        lang_a = get_language_code(bot_msg)
+        if lang_q != "unknown" and lang_a != "unknown" and lang_q != lang_a:
+            print(f"ID {current_id}: Skipped (Language mismatch: Q={lang_q}, A={lang_a})")
+            continue
+
+        # 同一批內完全相同的問題，只保留第一筆
+        if clean_q in seen_questions:
+            print(f"ID {current_id}: Skipped (Duplicate within batch)")
+            continue
+        seen_questions.add(clean_q)
+        candidates.append({"log_id": current_id, "question": clean_q, "answer": bot_msg})
+    return candidates
+
+def remove_existing_questions(supabase, candidates):
+    """第一層過濾：以批次 in_ 查詢排除 FAQ 中已有完全相同文字的問題。"""
+    questions = [candidate["question"] for candidate in candidates]
+    existing = set()
+    for chunk in _chunks(questions, IN_FILTER_CHUNK_SIZE):
+        response = supabase.table("faq").select("question").in_("question", chunk).execute()
+        existing.update(row["question"] for row in response.data or [])
+    for candidate in candidates:
+        if candidate["question"] in existing:
+            print(f"ID {candidate['log_id']}: Skipped (Exact string match found)")
+    return [candidate for candidate in candidates if candidate["question"] not in existing]
+
+def get_embeddings(openai_client, texts):
+    """以單次 embeddings 請求取得整批文字的向量 (超過 API 上限時才分批)。"""
+    vectors = []
+    for chunk in _chunks(texts, EMBEDDING_MAX_INPUTS):
+        response = openai_client.embeddings.create(
+            input=chunk,
+            model=EMBEDDING_MODEL,
+            dimensions=EMBEDDING_DIMENSIONS
+        )
+        vectors.extend(item.embedding for item in sorted(response.data, key=lambda item: item.index))
+    return vectors
+
+def remove_semantic_duplicates_in_batch(candidates, vectors, threshold=MATCH_THRESHOLD):
+    """在本機以向量矩陣比對同一批內語意重複的問題，只保留較早出現的一筆。"""
+    if not candidates:
+        return [], []
+    matrix = np.asarray(vectors, dtype=np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True) + 1e-12
+    similarities = matrix @ matrix.T
+    kept_indexes = []
+    for i, candidate in enumerate(candidates):
+        if kept_indexes and similarities[i, kept_indexes].max() > threshold:
+            print(f"ID {candidate['log_id']}: Skipped (Semantic duplicate within batch)")
+            continue
+        kept_indexes.append(i)
+    return [candidates[i] for i in kept_indexes], [vectors[i] for i in kept_indexes]
+
+def remove_duplicates_with_index(dedup_index, candidates, vectors):
+    """以本機去重索引一次比對整批候選問題，排除與既有 (或本輪已接受) FAQ 語意重複者。"""
+    similarities = dedup_index.max_similarities(vectors)
+    kept_candidates, kept_vectors = [], []
+    for candidate, vector, similarity in zip(candidates, vectors, similarities):
+        if similarity > dedup_index.threshold:
+            print(f"ID {candidate['log_id']}: Skipped (Semantic duplicate found)")
+            continue
+        kept_candidates.append(candidate)
+        kept_vectors.append(vector)
+    return kept_candidates, kept_vectors
+
+def remove_semantic_duplicates_in_db(supabase, candidates, vectors):
+    """第二層過濾：以 match_faq RPC 排除資料庫中已有語意重複的問題 (未使用本機索引時)。"""
+    kept_candidates, kept_vectors = [], []
+    for candidate, vector in zip(candidates, vectors):
+        dup_check = supabase.rpc("match_faq", {
+            "query_embedding": vector,
+            "match_threshold": MATCH_THRESHOLD,
+            "match_count": 1
+        }).execute()
+        if dup_check.data:
+            print(f"ID {candidate['log_id']}: Skipped (Semantic duplicate found)")
+            continue
+        kept_candidates.append(candidate)
+        kept_vectors.append(vector)
+    return kept_candidates, kept_vectors
+
+def mark_processed(supabase, log_ids):
+    """以批次 in_ 更新將整批紀錄標記為已處理。"""
+    for chunk in _chunks(list(log_ids), IN_FILTER_CHUNK_SIZE):
+        supabase.table(HISTORY_TABLE).update({"is_processed": True}).in_("id", chunk).execute()
+
+def process_logs(supabase, openai_client, logs, dedup_index=None):
+    """
+    處理指定的 chatbot 回應：過濾、去重、寫入 FAQ，最後標記為已處理。
+    傳入 dedup_index 時，文字與語意重複都在本機比對，不再逐筆查詢 faq 表或呼叫 match_faq；
+    比對前會先增量載入其他程式 (例如 auto-faq edge function) 在這段期間新增的 FAQ。
+    """
+    previous_by_id = fetch_previous_messages(supabase, logs)
+    candidates = build_candidates(logs, previous_by_id)
+    if candidates and dedup_index is not None:
+        dedup_index.refresh(supabase)
+        for candidate in candidates:
+            if dedup_index.contains_question(candidate["question"]):
+                print(f"ID {candidate['log_id']}: Skipped (Exact string match found)")
+        candidates = [candidate for candidate in candidates if not dedup_index.contains_question(candidate["question"])]
+    elif candidates:
+        candidates = remove_existing_questions(supabase, candidates)
+    if candidates:
+        # Embedding 放在文字比對之後做，省錢
+        vectors = get_embeddings(openai_client, [candidate["question"] for candidate in candidates])
+        candidates, vectors = remove_semantic_duplicates_in_batch(candidates, vectors)
+        if dedup_index is not None:
+            candidates, vectors = remove_duplicates_with_index(dedup_index, candidates, vectors)
+            for candidate, vector in zip(candidates, vectors):
+                dedup_index.add(candidate["question"], candidate["answer"], vector)
+        else:
+            candidates, vectors = remove_semantic_duplicates_in_db(supabase, candidates, vectors)
+            if candidates:
+                supabase.table("faq").insert([
+                    {"question": candidate["question"], "answer": candidate["answer"], "embedding": vector}
+                    for candidate, vector in zip(candidates, vectors)
+                ]).execute()
+        if candidates:
+            print(f"  -> Success: Accepted {len(candidates)} FAQs")
+    if dedup_index is not None:
+        # 先前批次若寫入失敗，暫存的 FAQ 也會在這裡一併重試
+        dedup_index.flush(supabase)
+
+    # 整批處理完成後才標記；若中途出錯，整批會在下一輪重試 (已寫入的 FAQ 會被文字比對擋下)
+    mark_processed(supabase, [log["id"] for log in logs])
+
+def process_batch(supabase, openai_client, batch_size=BATCH_SIZE, dedup_index=None):
+    """處理一批未處理的紀錄，回傳這批的筆數 (0 表示已沒有待處理的資料)。"""
+    logs = fetch_unprocessed_bot_logs(supabase, batch_size)
+    if not logs:
+        return 0
+    print(f"Processing batch of {len(logs)} logs...")
+    process_logs(supabase, openai_client, logs, dedup_index)
+    return len(logs)
+
+def process_batch_isolating_failures(supabase, openai_client, batch_size=BATCH_SIZE, dedup_index=None):
+    """
+    同一批重試 MAX_BATCH_ATTEMPTS 次仍失敗時使用：將批次對半切分處理，找出造成失敗的紀錄
+    (例如超過 embedding 長度上限的訊息)，將其標記為已處理後略過，其餘紀錄照常寫入。
+    若失敗的紀錄超過 MAX_ISOLATED_FAILURES 筆，或多筆的批次全部失敗，視為系統性錯誤
+    (例如資料庫或 API 無法連線)，拋出例外且不略過任何失敗的紀錄 (已成功的部分仍會保留)。
+    回傳這批的筆數。
+    """
+    logs = fetch_unprocessed_bot_logs(supabase, batch_size)
+    if not logs:
+        return 0
+    print(f"Isolating failures in batch of {len(logs)} logs...")
+    failed_logs = []
+
+    def process_part(part):
+        try:
+            process_logs(supabase, openai_client, part, dedup_index)
+            return
+        except Exception as e:
+            if len(part) == 1:
+                print(f"ID {part[0]['id']}: Failed ({e})")
+                failed_logs.append(part[0])
+                if len(failed_logs) > MAX_ISOLATED_FAILURES:
+                    raise RuntimeError(f"切分後已有超過 {MAX_ISOLATED_FAILURES} 筆紀錄失敗，視為系統性錯誤: {e}") from e
+                return
+        middle = len(part) // 2
+        process_part(part[:middle])
+        process_part(part[middle:])
+
+    process_part(logs)
+    if len(logs) > 1 and len(failed_logs) == len(logs):
+        raise RuntimeError(f"批次中的 {len(logs)} 筆紀錄全部失敗，視為系統性錯誤。")
+    if failed_logs:
+        mark_processed(supabase, [log["id"] for log in failed_logs])
+        print(f"  -> Skipped {len(failed_logs)} logs that kept failing: {[log['id'] for log in failed_logs]}")
+    return len(logs)
+
+def backfill_history(supabase, openai_client, follow=False, use_local_index=True):
+    """
+    逐批回填歷史紀錄，直到沒有未處理的資料為止。
+    follow=True 時持續監看新資料，沒有資料時休息的秒數會逐次加倍 (上限 MAX_IDLE_SLEEP_SECONDS)。
+    use_local_index=True 時先將既有 FAQ 載入本機去重索引，整輪只需讀取一次 faq 表。
+    同一批連續失敗 MAX_BATCH_ATTEMPTS 次後，改為切分批次略過造成失敗的紀錄；
+    若切分後仍判定為系統性錯誤，非監看模式下會拋出例外結束，監看模式下則休息後重新開始。
+    """
+    if detect is None:
+        print("⚠️ 警告：未安裝 langdetect，語言一致性檢查 (過濾邏輯 4) 已停用，問答語言不一致的紀錄也會被寫入 FAQ。請執行 pip install langdetect。")
+    dedup_index = FaqDedupIndex.load(supabase, EMBEDDING_DIMENSIONS, MATCH_THRESHOLD) if use_local_index else None
+    print("Scanning for unprocessed logs...")
+    total_processed = 0
+    idle_sleep = IDLE_SLEEP_SECONDS
+    failures = 0
+    while True:
+        try:
+            if failures < MAX_BATCH_ATTEMPTS:
+                processed = process_batch(supabase, openai_client, dedup_index=dedup_index)
+            else:
+                processed = process_batch_isolating_failures(supabase, openai_client, dedup_index=dedup_index)
+            failures = 0
+        except Exception as e:
+            failures += 1
+            print(f"Main Loop Error (attempt {failures}): {e}")
+            if failures > MAX_BATCH_ATTEMPTS:
+                if not follow:
+                    raise
+                failures = 0
+                time.sleep(MAX_IDLE_SLEEP_SECONDS)
+            else:
+                time.sleep(RETRY_SLEEP_SECONDS)
+            continue
+        if processed:
+            total_processed += processed
+            idle_sleep = IDLE_SLEEP_SECONDS
+            continue
+        if not follow:
+            break
+        print(f"No unprocessed logs found. Sleeping {idle_sleep} seconds...")
+        time.sleep(idle_sleep)
+        idle_sleep = min(idle_sleep * 2, MAX_IDLE_SLEEP_SECONDS)
+    print(f"Backfill finished, {total_processed} logs processed.")
+    return total_processed
+
+def main():
+    parser = argparse.ArgumentParser(description="將歷史對話紀錄批次回填為 FAQ。")
+    parser.add_argument("--follow", action="store_true", help="處理完後持續監看新資料")
+    parser.add_argument("--local", action="store_true", help="使用本地模擬的 Supabase 與 embedding API 執行 (不連線)")
+    parser.add_argument("--remote-dedup", action="store_true", help="不使用本機去重索引，改為逐筆查詢 faq 表與呼叫 match_faq")
+    args = parser.parse_args()
+
+    if args.local:
+        from faq_backfill.local_stubs import LocalSupabaseClient, LocalEmbeddingClient, seed_history
+        supabase = LocalSupabaseClient(seed_history(history_table=HISTORY_TABLE))
+        openai_client = LocalEmbeddingClient()
+    else:
+        supabase, openai_client = initialize_clients()
+        if not supabase:
+            return
+
+    start_time = time.time()
+    backfill_history(supabase, openai_client, follow=args.follow, use_local_index=not args.remote_dedup)
+
+    if args.local:
+        print(f"\n(本地模擬) 耗時 {time.time() - start_time:.2f} 秒，FAQ 共 {len(supabase.tables['faq'])} 筆。")
+        print(f"(本地模擬) embeddings 請求 {openai_client.request_count} 次 (共 {openai_client.input_count} 筆文字)")
+        for operation, count in sorted(supabase.call_counts.items()):
+            print(f"(本地模擬) {operation}: {count} 次")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+import json
+
+import numpy as np
+
+MATCH_THRESHOLD = 0.92   # 與 match_faq 相同的語意重複門檻
+LOAD_PAGE_SIZE = 1000    # 載入既有 FAQ 時每頁的筆數
+
+
+class FaqDedupIndex:
+    """
+    FAQ 的本機去重索引：將既有 FAQ 的 embedding 一次載入成正規化的 NumPy 矩陣，
+    以矩陣乘法取代逐筆的 match_faq RPC。本輪新接受的 FAQ 會立即加入索引並暫存，
+    之後以 flush 一次寫回資料庫，因此同一輪中尚未寫入的 FAQ 也能被比對到。
+    其他程式 (例如 auto-faq edge function) 在回填期間新增的 FAQ，以 refresh 依 id 增量載入。
+    (以暴力法計算完整相似度，數萬筆以內的 FAQ 都能在毫秒級完成。)
+    """
+    def __init__(self, dimensions=1536, threshold=MATCH_THRESHOLD):
+        self.threshold = threshold
+        self.questions = set()
+        self.pending_rows = []
+        self.last_id = 0   # 已載入的 faq 最大 id
+        self._matrix = np.zeros((256, dimensions), dtype=np.float32)
+        self._size = 0
+
+    @classmethod
+    def load(cls, supabase, dimensions=1536, threshold=MATCH_THRESHOLD):
+        """分頁讀取 faq 表中所有問題與 embedding，建立索引。"""
+        index = cls(dimensions, threshold)
+        index.refresh(supabase)
+        print(f"✅ 已載入 {len(index)} 筆既有 FAQ 向量至本機去重索引。")
+        return index
+
+    def refresh(self, supabase):
+        """
+        分頁讀取 id 大於 last_id 的 FAQ 加入索引，回傳讀到的筆數。
+        本索引自己寫入的 FAQ 也會被讀回，但問題文字已在 questions 中，不會重複加入矩陣。
+        """
+        loaded = 0
+        while True:
+            response = supabase.table("faq")\
+                .select("id, question, embedding")\
+                .gt("id", self.last_id)\
+                .order("id")\
+                .limit(LOAD_PAGE_SIZE)\
+                .execute()
+            rows = response.data or []
+            for row in rows:
+                self.last_id = max(self.last_id, row["id"])
+                if row["question"] in self.questions:
+                    continue
+                self.questions.add(row["question"])
+                embedding = row.get("embedding")
+                if embedding is None:
+                    continue
+                # PostgREST 會將 pgvector 欄位以 "[0.1,0.2,...]" 字串回傳
+                if isinstance(embedding, str):
+                    embedding = json.loads(embedding)
+                self._append(embedding)
+            loaded += len(rows)
+            if len(rows) < LOAD_PAGE_SIZE:
+                return loaded
+
+    def __len__(self):
+        return self._size
+
+    def _append(self, vector):
+        if self._size == self._matrix.shape[0]:
+            # 容量不足時加倍，避免每新增一筆就複製整個矩陣
+            grown = np.zeros((self._matrix.shape[0] * 2, self._matrix.shape[1]), dtype=np.float32)
+            grown[:self._size] = self._matrix[:self._size]
+            self._matrix = grown
+        vector = np.asarray(vector, dtype=np.float32)
+        self._matrix[self._size] = vector / (np.linalg.norm(vector) + 1e-12)
+        self._size += 1
+
+    def contains_question(self, question):
+        """是否已有完全相同文字的問題。"""
+        return question in self.questions
+
+    def max_similarities(self, vectors):
+        """一次計算多個向量與索引中所有 FAQ 的最高餘弦相似度。"""
+        if not len(vectors):
+            return np.zeros(0, dtype=np.float32)
+        queries = np.asarray(vectors, dtype=np.float32)
+        queries /= np.linalg.norm(queries, axis=1, keepdims=True) + 1e-12
+        if not self._size:
+            return np.zeros(len(queries), dtype=np.float32)
+        return (queries @ self._matrix[:self._size].T).max(axis=1)
+
+    def add(self, question, answer, vector):
+        """將新接受的 FAQ 加入索引，並暫存待寫回資料庫。"""
+        self._append(vector)
+        self.questions.add(question)
+        self.pending_rows.append({"question": question, "answer": answer, "embedding": list(vector)})
+
+    def flush(self, supabase):
+        """將暫存的新 FAQ 以單次 insert 寫回資料庫，回傳寫入筆數。"""
+        if not self.pending_rows:
+            return 0
+        supabase.table("faq").insert(self.pending_rows).execute()
+        written = len(self.pending_rows)
+        self.pending_rows = []
+        return written
@@ -0,0 +1,213 @@
+import hashlib
+import math
+import re
+from collections import Counter
+
+
+class _LocalResponse:
+    """模擬 supabase-py 的回應物件，只提供 data 屬性。"""
+    def __init__(self, data):
+        self.data = data
+
+
+class _LocalQuery:
+    """模擬 supabase-py 查詢建構器的最小子集合 (select / insert / update 與常用篩選條件)。"""
+    def __init__(self, client, table_name):
+        self.client = client
+        self.table_name = table_name
+        self.operation = "select"
+        self.columns = "*"
+        self.payload = None
+        self.filters = []
+        self.order_by = None
+        self.offset = 0
+        self.limit_count = None
+
+    def select(self, columns="*"):
+        self.operation, self.columns = "select", columns
+        return self
+
+    def insert(self, rows):
+        self.operation, self.payload = "insert", rows if isinstance(rows, list) else [rows]
+        return self
+
+    def update(self, values):
+        self.operation, self.payload = "update", values
+        return self
+
+    def eq(self, column, value):
+        self.filters.append(lambda row: row.get(column) == value)
+        return self
+
+    def lt(self, column, value):
+        self.filters.append(lambda row: row.get(column) is not None and row[column] < value)
+        return self
+
+    def gt(self, column, value):
+        self.filters.append(lambda row: row.get(column) is not None and row[column] > value)
+        return self
+
+    def lte(self, column, value):
+        self.filters.append(lambda row: row.get(column) is not None and row[column] <= value)
+        return self
+
+    def gte(self, column, value):
+        self.filters.append(lambda row: row.get(column) is not None and row[column] >= value)
+        return self
+
+    def in_(self, column, values):
+        value_set = set(values)
+        self.filters.append(lambda row: row.get(column) in value_set)
+        return self
+
+    def order(self, column, desc=False):
+        self.order_by = (column, desc)
+        return self
+
+    def limit(self, count):
+        self.limit_count = count
+        return self
+
+    def range(self, start, end):
+        self.offset, self.limit_count = start, end - start + 1
+        return self
+
+    def execute(self):
+        self.client.call_counts[f"{self.operation}:{self.table_name}"] += 1
+        rows = self.client.tables.setdefault(self.table_name, [])
+
+        if self.operation == "insert":
+            inserted = []
+            for row in self.payload:
+                new_row = dict(row)
+                new_row.setdefault("id", max((r["id"] for r in rows), default=0) + 1)
+                rows.append(new_row)
+                inserted.append(dict(new_row))
+            return _LocalResponse(inserted)
+
+        matched = [row for row in rows if all(condition(row) for condition in self.filters)]
+        if self.operation == "update":
+            for row in matched:
+                row.update(self.payload)
+            return _LocalResponse([dict(row) for row in matched])
+
+        if self.order_by:
+            column, desc = self.order_by
+            matched = sorted(matched, key=lambda row: row.get(column), reverse=desc)
+        limit_count = self.limit_count
+        if self.client.max_rows is not None:
+            limit_count = min(limit_count or self.client.max_rows, self.client.max_rows)
+        if limit_count is not None:
+            matched = matched[self.offset:self.offset + limit_count]
+        if self.columns.strip() == "*":
+            return _LocalResponse([dict(row) for row in matched])
+        columns = [column.strip() for column in self.columns.split(",")]
+        return _LocalResponse([{column: row.get(column) for column in columns} for row in matched])
+
+
+class _LocalRpc:
+    def __init__(self, client, function_name, params):
+        self.client = client
+        self.function_name = function_name
+        self.params = params
+
+    def execute(self):
+        self.client.call_counts[f"rpc:{self.function_name}"] += 1
+        if self.function_name != "match_faq":
+            raise ValueError(f"本地模擬不支援 RPC '{self.function_name}'")
+        # 與資料庫中的 match_faq 相同：回傳相似度高於門檻的 FAQ，依相似度由高到低排序
+        query = self.params["query_embedding"]
+        matches = []
+        for row in self.client.tables.get("faq", []):
+            similarity = cosine_similarity(query, row["embedding"])
+            if similarity > self.params["match_threshold"]:
+                matches.append({"id": row["id"], "question": row["question"], "answer": row["answer"], "similarity": similarity})
+        matches.sort(key=lambda match: match["similarity"], reverse=True)
+        return _LocalResponse(matches[:self.params["match_count"]])
+
+
+class LocalSupabaseClient:
+    """
+    在記憶體中模擬 supabase-py Client 的最小子集合 (table 查詢與 match_faq RPC)，
+    並以 call_counts 記錄每種資料庫操作的次數，用來在本機驗證回填流程與比較網路往返次數。
+    max_rows 模擬 PostgREST 的單次回傳筆數上限 (db-max-rows)，超過的部分會被截斷。
+    """
+    def __init__(self, tables=None, max_rows=None):
+        self.tables = {name: [dict(row) for row in rows] for name, rows in (tables or {}).items()}
+        self.call_counts = Counter()
+        self.max_rows = max_rows
+
+    def table(self, table_name):
+        return _LocalQuery(self, table_name)
+
+    def rpc(self, function_name, params):
+        return _LocalRpc(self, function_name, params)
+
+
+class _LocalEmbeddingItem:
+    def __init__(self, index, embedding):
+        self.index = index
+        self.embedding = embedding
+
+
+class _LocalEmbeddingResponse:
+    def __init__(self, data):
+        self.data = data
+
+
+class _LocalEmbeddings:
+    def __init__(self, client):
+        self.client = client
+
+    def create(self, input, model, dimensions=1536):
+        texts = [input] if isinstance(input, str) else list(input)
+        self.client.request_count += 1
+        self.client.input_count += len(texts)
+        return _LocalEmbeddingResponse([
+            _LocalEmbeddingItem(i, local_embedding(text, dimensions)) for i, text in enumerate(texts)
+        ])
+
+
+class LocalEmbeddingClient:
+    """
+    模擬 OpenAI Client 的 embeddings.create 介面，以字元 bigram 雜湊產生可重現的向量
+    (文字越相近、向量越相似)，並記錄請求次數與輸入筆數。
+    """
+    def __init__(self):
+        self.request_count = 0
+        self.input_count = 0
+        self.embeddings = _LocalEmbeddings(self)
+
+
+def local_embedding(text, dimensions=1536):
+    """將文字的字元 bigram 雜湊到固定維度後正規化，作為本地模擬用的 embedding。"""
+    text = re.sub(r'\s+', '', text or "")
+    grams = [text[i:i + 2] for i in range(len(text) - 1)] or [text]
+    vector = [0.0] * dimensions
+    for gram in grams:
+        digest = hashlib.md5(gram.encode("utf-8")).digest()
+        vector[int.from_bytes(digest[:4], "little") % dimensions] += 1.0
+    norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+    return [v / norm for v in vector]
+
+
+def cosine_similarity(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+def seed_history(pair_count=200, history_table="taipei_marathon_history"):
+    """產生本地模擬用的歷史對話資料 (people 提問、chatbot 回答交錯)，其中包含重複與無效的問題。"""
+    topics = ["報名截止日期", "領物地點", "起跑時間", "寄物服務", "交通管制路段", "完賽獎牌", "補給站位置", "退費規定"]
+    rows = []
+    next_id = 1
+    for i in range(pair_count):
+        topic = topics[i % len(topics)]
+        # 每 3 題加上不同的語助詞，模擬語意相同但字面不同的重複問題
+        question = f"關於台北馬拉松所有賽事有些相關問題想請教，{topic}{'是什麼' if i % 3 else '是什麼呢'}，請翻閱知識庫回答。"
+        answer = "" if i % 17 == 0 else f"{topic}的相關說明請參考大會公告第 {i % len(topics) + 1} 條。"
+        rows.append({"id": next_id, "who": "people", "message": question, "is_processed": False})
+        rows.append({"id": next_id + 1, "who": "chatbot", "message": answer, "is_processed": False})
+        next_id += 2
+    return {history_table: rows, "faq": []}
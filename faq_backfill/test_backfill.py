@@ -0,0 +1,278 @@
+"""
+以本地模擬的 Supabase / OpenAI 客戶端驗證批次回填流程，不需要網路或金鑰。
+執行方式 (於專案根目錄)：python -m pytest -q faq_backfill  或  python -m unittest faq_backfill.test_backfill
+"""
+import contextlib
+import io
+import unittest
+from unittest import mock
+
+from faq_backfill import backfill
+from faq_backfill.local_stubs import LocalEmbeddingClient, LocalSupabaseClient, local_embedding, seed_history
+
+TOPICS = ["報名截止日期", "領物地點", "起跑時間", "寄物服務", "交通管制路段", "完賽獎牌", "補給站位置", "退費規定"]
+
+
+def history_rows(supabase):
+    return supabase.tables[backfill.HISTORY_TABLE]
+
+
+def unprocessed_bot_ids(supabase):
+    return [row["id"] for row in history_rows(supabase) if row["who"] == "chatbot" and not row["is_processed"]]
+
+
+def failing_embedding_client(should_fail):
+    """embeddings.create 在 should_fail(輸入) 為真時拋出例外，模擬超過長度上限或 API 無法連線。"""
+    client = LocalEmbeddingClient()
+    create = client.embeddings.create
+
+    def create_or_fail(input, model, dimensions=1536):
+        if should_fail(input):
+            raise ValueError("400 input too long")
+        return create(input, model, dimensions)
+
+    client.embeddings.create = create_or_fail
+    return client
+
+
+def paired_history(pair_count, extra_every=10):
+    """產生一問一答的歷史紀錄，每 extra_every 題前多插入一句使用者訊息，回傳 (rows, {回應 id: 上一句 id})。"""
+    rows, expected = [], {}
+    next_id = 1
+    for i in range(pair_count):
+        if i % extra_every == 0:
+            rows.append({"id": next_id, "who": "people", "message": f"補充說明 {i}", "is_processed": False})
+            next_id += 1
+        rows.append({"id": next_id, "who": "people", "message": f"問題 {i}", "is_processed": False})
+        rows.append({"id": next_id + 1, "who": "chatbot", "message": f"回答 {i}", "is_processed": False})
+        expected[next_id + 1] = next_id
+        next_id += 2
+    return rows, expected
+
+
+class BackfillTestCase(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(backfill, "RETRY_SLEEP_SECONDS", 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_quietly(self, function, *args, **kwargs):
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            result = function(*args, **kwargs)
+        self.output = output.getvalue()
+        return result
+
+
+class RoundTripTests(BackfillTestCase):
+    def test_local_index_uses_one_read_and_one_write_for_faq(self):
+        supabase = LocalSupabaseClient(seed_history(200, backfill.HISTORY_TABLE))
+        openai_client = LocalEmbeddingClient()
+
+        processed = self.run_quietly(backfill.backfill_history, supabase, openai_client, use_local_index=True)
+
+        self.assertEqual(processed, 200)
+        self.assertEqual(openai_client.request_count, 1)
+        # 啟動時載入一次，處理批次前再增量載入一次
+        self.assertEqual(supabase.call_counts["select:faq"], 2)
+        self.assertEqual(supabase.call_counts["insert:faq"], 1)
+        self.assertEqual(supabase.call_counts["rpc:match_faq"], 0)
+        # 取批次、取上一句區間、確認沒有剩餘資料
+        self.assertEqual(supabase.call_counts[f"select:{backfill.HISTORY_TABLE}"], 3)
+        self.assertEqual(supabase.call_counts[f"update:{backfill.HISTORY_TABLE}"], 2)
+        self.assertEqual(unprocessed_bot_ids(supabase), [])
+
+    def test_remote_dedup_checks_each_remaining_candidate_once(self):
+        supabase = LocalSupabaseClient(seed_history(200, backfill.HISTORY_TABLE))
+        openai_client = LocalEmbeddingClient()
+
+        self.run_quietly(backfill.backfill_history, supabase, openai_client, use_local_index=False)
+
+        self.assertEqual(openai_client.request_count, 1)
+        self.assertEqual(supabase.call_counts["rpc:match_faq"], len(supabase.tables["faq"]))
+        self.assertEqual(supabase.call_counts["insert:faq"], 1)
+
+    def test_second_run_does_nothing(self):
+        supabase = LocalSupabaseClient(seed_history(50, backfill.HISTORY_TABLE))
+        self.run_quietly(backfill.backfill_history, supabase, LocalEmbeddingClient())
+        faq_count = len(supabase.tables["faq"])
+        openai_client = LocalEmbeddingClient()
+
+        processed = self.run_quietly(backfill.backfill_history, supabase, openai_client)
+
+        self.assertEqual(processed, 0)
+        self.assertEqual(openai_client.request_count, 0)
+        self.assertEqual(len(supabase.tables["faq"]), faq_count)
+
+
+class DedupeTests(BackfillTestCase):
+    def test_in_batch_duplicates_are_inserted_once(self):
+        for use_local_index in (True, False):
+            with self.subTest(use_local_index=use_local_index):
+                supabase = LocalSupabaseClient(seed_history(200, backfill.HISTORY_TABLE))
+                openai_client = LocalEmbeddingClient()
+
+                processed = self.run_quietly(
+                    backfill.process_batch, supabase, openai_client,
+                    dedup_index=backfill.FaqDedupIndex.load(supabase, backfill.EMBEDDING_DIMENSIONS) if use_local_index else None,
+                )
+
+                questions = [row["question"] for row in supabase.tables["faq"]]
+                self.assertEqual(processed, 200)
+                self.assertEqual(len(questions), len(TOPICS))
+                for topic in TOPICS:
+                    self.assertEqual(sum(topic in question for question in questions), 1, topic)
+
+    def test_faq_added_by_another_writer_between_batches_is_deduplicated(self):
+        # 第一批 (前 8 組) 的第一題回答為空而被略過，「報名截止日期」要到第二批才會出現
+        supabase = LocalSupabaseClient(seed_history(16, backfill.HISTORY_TABLE))
+        openai_client = LocalEmbeddingClient()
+        dedup_index = backfill.FaqDedupIndex.load(supabase, backfill.EMBEDDING_DIMENSIONS)
+        self.run_quietly(backfill.process_batch, supabase, openai_client, batch_size=8, dedup_index=dedup_index)
+        self.assertEqual(len(supabase.tables["faq"]), len(TOPICS) - 1)
+
+        # 模擬 auto-faq edge function 在兩批之間新增的 FAQ：一筆語意相同、一筆文字完全相同
+        supabase.table("faq").insert([
+            {"question": "報名截止日期是什麼呢", "answer": "請見大會公告。", "embedding": local_embedding("報名截止日期是什麼呢")},
+            {"question": "領物地點在哪裡", "answer": "請見大會公告。", "embedding": local_embedding("領物地點在哪裡")},
+        ]).execute()
+        history_rows(supabase).append({"id": 1000, "who": "people", "message": "領物地點在哪裡", "is_processed": False})
+        history_rows(supabase).append({"id": 1001, "who": "chatbot", "message": "領物地點請見大會公告。", "is_processed": False})
+
+        self.run_quietly(backfill.process_batch, supabase, openai_client, dedup_index=dedup_index)
+
+        self.assertIn("Skipped (Exact string match found)", self.output)
+        self.assertIn("Skipped (Semantic duplicate found)", self.output)
+        self.assertEqual(len(supabase.tables["faq"]), len(TOPICS) + 1)
+        self.assertEqual(unprocessed_bot_ids(supabase), [])
+
+
+class PreviousMessageTests(BackfillTestCase):
+    def test_window_larger_than_row_cap_is_paged(self):
+        rows, expected = paired_history(500)
+        supabase = LocalSupabaseClient({backfill.HISTORY_TABLE: rows, "faq": []}, max_rows=1000)
+        logs = backfill.fetch_unprocessed_bot_logs(supabase)
+
+        previous_by_id = backfill.fetch_previous_messages(supabase, logs)
+
+        self.assertEqual(len(logs), 500)
+        self.assertEqual({log_id: row["id"] for log_id, row in previous_by_id.items()}, expected)
+        self.assertGreater(supabase.call_counts[f"select:{backfill.HISTORY_TABLE}"], 2)
+
+    def test_window_short_page_does_not_pair_with_wrong_row(self):
+        # 每頁只回傳 200 筆時仍需正確配對，不能把區間不完整誤當成中間沒有資料
+        rows, expected = paired_history(150)
+        supabase = LocalSupabaseClient({backfill.HISTORY_TABLE: rows, "faq": []}, max_rows=200)
+        logs = backfill.fetch_unprocessed_bot_logs(supabase, batch_size=150)
+
+        with mock.patch.object(backfill, "WINDOW_PAGE_SIZE", 1000):
+            previous_by_id = backfill.fetch_previous_messages(supabase, logs)
+
+        self.assertEqual({log_id: row["id"] for log_id, row in previous_by_id.items()}, expected)
+
+    def test_gap_before_batch_falls_back_to_single_lookup(self):
+        gap = backfill.PREVIOUS_MESSAGE_WINDOW * 5
+        rows = [
+            {"id": 1, "who": "people", "message": "第一題", "is_processed": False},
+            {"id": 2 + gap, "who": "chatbot", "message": "第一題的回答", "is_processed": False},
+            {"id": 3 + gap, "who": "people", "message": "第二題", "is_processed": False},
+            {"id": 4 + gap, "who": "chatbot", "message": "第二題的回答", "is_processed": False},
+        ]
+        supabase = LocalSupabaseClient({backfill.HISTORY_TABLE: rows, "faq": []})
+        logs = backfill.fetch_unprocessed_bot_logs(supabase)
+
+        previous_by_id = backfill.fetch_previous_messages(supabase, logs)
+
+        self.assertEqual(previous_by_id[2 + gap]["id"], 1)
+        self.assertEqual(previous_by_id[4 + gap]["id"], 3 + gap)
+        # 一次區間查詢，加上第一筆回應的個別查詢
+        self.assertEqual(supabase.call_counts[f"select:{backfill.HISTORY_TABLE}"], 3)
+
+    def test_sparse_unprocessed_replies_do_not_scan_the_table(self):
+        # 持續監看模式下，大部分紀錄已被 edge function 處理，只剩零散的幾筆回應
+        rows, expected = paired_history(20000)
+        bot_ids = sorted(expected)
+        unprocessed = {bot_ids[0], bot_ids[-1], *bot_ids[10000:10005]}
+        for row in rows:
+            row["is_processed"] = row["id"] not in unprocessed
+        supabase = LocalSupabaseClient({backfill.HISTORY_TABLE: rows, "faq": []}, max_rows=1000)
+        logs = backfill.fetch_unprocessed_bot_logs(supabase)
+        supabase.call_counts.clear()
+
+        previous_by_id = backfill.fetch_previous_messages(supabase, logs)
+
+        self.assertEqual({log_id: row["id"] for log_id, row in previous_by_id.items()},
+                         {log_id: expected[log_id] for log_id in unprocessed})
+        # 兩端各一次個別查詢，中間連續的 5 筆一次區間查詢
+        self.assertLessEqual(supabase.call_counts[f"select:{backfill.HISTORY_TABLE}"], 3)
+
+    def test_split_into_runs(self):
+        self.assertEqual(backfill.split_into_runs([1, 3, 5, 100, 102, 5000], max_gap=20), [[1, 3, 5], [100, 102], [5000]])
+
+    def test_first_message_has_no_previous(self):
+        rows = [{"id": 1, "who": "chatbot", "message": "歡迎使用", "is_processed": False}]
+        supabase = LocalSupabaseClient({backfill.HISTORY_TABLE: rows, "faq": []})
+
+        previous_by_id = backfill.fetch_previous_messages(supabase, rows)
+
+        self.assertEqual(previous_by_id, {1: None})
+
+    def test_batch_over_capped_window_pairs_questions_with_their_answers(self):
+        supabase = LocalSupabaseClient(seed_history(200, backfill.HISTORY_TABLE), max_rows=100)
+
+        self.run_quietly(backfill.backfill_history, supabase, LocalEmbeddingClient())
+
+        self.assertEqual(unprocessed_bot_ids(supabase), [])
+        self.assertEqual(len(supabase.tables["faq"]), len(TOPICS))
+        for row in supabase.tables["faq"]:
+            topic = next(topic for topic in TOPICS if topic in row["question"])
+            self.assertTrue(row["answer"].startswith(topic), row)
+
+
+class RetryTests(BackfillTestCase):
+    def test_row_that_keeps_failing_is_skipped_and_marked(self):
+        data = seed_history(60, backfill.HISTORY_TABLE)
+        poisoned_question_id = 41
+        for row in data[backfill.HISTORY_TABLE]:
+            if row["id"] == poisoned_question_id:
+                row["message"] = "關於台北馬拉松所有賽事有些相關問題想請教，" + "超長" * 50 + "，請翻閱知識庫回答。"
+        supabase = LocalSupabaseClient(data)
+        openai_client = failing_embedding_client(lambda texts: any("超長" in text for text in texts))
+
+        processed = self.run_quietly(backfill.backfill_history, supabase, openai_client)
+
+        self.assertEqual(processed, 60)
+        self.assertEqual(unprocessed_bot_ids(supabase), [])
+        self.assertIn(f"ID {poisoned_question_id + 1}: Failed", self.output)
+        self.assertEqual(len(supabase.tables["faq"]), len(TOPICS))
+        self.assertFalse(any("超長" in row["question"] for row in supabase.tables["faq"]))
+
+    def test_outage_raises_without_skipping_rows(self):
+        supabase = LocalSupabaseClient(seed_history(60, backfill.HISTORY_TABLE))
+        pending = set(unprocessed_bot_ids(supabase))
+        openai_client = failing_embedding_client(lambda texts: True)
+
+        with self.assertRaises(Exception):
+            self.run_quietly(backfill.backfill_history, supabase, openai_client)
+
+        self.assertEqual(supabase.tables["faq"], [])
+        skipped = pending - set(unprocessed_bot_ids(supabase))
+        # 只有本來就會被過濾 (不需要 embedding) 的回應可以被標記為已處理
+        for log_id in skipped:
+            answer = next(row["message"] for row in history_rows(supabase) if row["id"] == log_id)
+            self.assertEqual(answer, "")
+
+    def test_retries_are_bounded_before_isolating(self):
+        supabase = LocalSupabaseClient(seed_history(20, backfill.HISTORY_TABLE))
+        calls = []
+        openai_client = failing_embedding_client(lambda texts: calls.append(len(texts)) or True)
+
+        with self.assertRaises(Exception):
+            self.run_quietly(backfill.backfill_history, supabase, openai_client)
+
+        full_batch_attempts = [count for count in calls if count == max(calls)]
+        self.assertGreaterEqual(len(full_batch_attempts), backfill.MAX_BATCH_ATTEMPTS)
+        self.assertLess(len(calls), 100)
+
+
+if __name__ == "__main__":
+    unittest.main()
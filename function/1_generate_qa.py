@@ -136,11 +136,13 @@ async def main():
     # 使用 asyncio.gather 並行執行所有任務
     results = await asyncio.gather(*tasks)
 
-    # 收集所有成功的結果
+    # 收集所有成功的結果，並記錄每組問答的來源區塊 (供 7_benchmark_retrieval.py 計算檢索召回率)
     all_qa_pairs = []
-    for result in results:
+    for section, result in zip(sections, results):
         if result and 'qa_pairs' in result:
-            all_qa_pairs.extend(result['qa_pairs'])
+            for qa_pair in result['qa_pairs']:
+                qa_pair['source_section'] = section['title']
+                all_qa_pairs.append(qa_pair)
 
     if all_qa_pairs:
         output_filename = "test_dataset.json"
@@ -45,13 +45,15 @@ async def run_single_test(sut, qa_pair, index, total):
 
     start_time = time.time()
     try:
-        actual_answer = await sut.process_query(question)
+        # 一併保存各階段的中間產物，供 4_optimize_prompt.py 判斷失敗發生在哪個階段
+        query_result = await sut.process_query(question, return_trace=True)
         duration = time.time() - start_time
         print(f"   ✅ 系統在 {duration:.2f} 秒內回覆。")
         return {
             "question": question,
             "golden_answer": golden_answer,
-            "actual_answer": actual_answer
+            "actual_answer": query_result["answer"],
+            "trace": query_result["trace"]
         }
     except Exception as e:
         duration = time.time() - start_time
@@ -80,25 +82,29 @@ async def main():
     test_results = []
     total_questions = len(test_data)
 
-    # 將所有測試資料分成多個批次
-    for i in range(0, total_questions, BATCH_SIZE):
-        batch = test_data[i:i + BATCH_SIZE]
-        batch_number = (i // BATCH_SIZE) + 1
-        print(f"\n--- 正在處理第 {batch_number} 批次 (問題 {i+1} 到 {min(i + BATCH_SIZE, total_questions)}) ---")
+    try:
+        # 將所有測試資料分成多個批次
+        for i in range(0, total_questions, BATCH_SIZE):
+            batch = test_data[i:i + BATCH_SIZE]
+            batch_number = (i // BATCH_SIZE) + 1
+            print(f"\n--- 正在處理第 {batch_number} 批次 (問題 {i+1} 到 {min(i + BATCH_SIZE, total_questions)}) ---")
 
-        # 為當前批次的每個問題建立非同步任務
-        tasks = [run_single_test(sut, qa_pair, i + j, total_questions) for j, qa_pair in enumerate(batch)]
-        
-        # 並行執行當前批次的任務
-        batch_results = await asyncio.gather(*tasks)
-        
-        # 收集結果
-        test_results.extend([res for res in batch_results if res is not None])
+            # 為當前批次的每個問題建立非同步任務
+            tasks = [run_single_test(sut, qa_pair, i + j, total_questions) for j, qa_pair in enumerate(batch)]
+            
+            # 並行執行當前批次的任務
+            batch_results = await asyncio.gather(*tasks)
+            
+            # 收集結果
+            test_results.extend([res for res in batch_results if res is not None])
 
-        # 如果這不是最後一批，則進行延遲
-        if i + BATCH_SIZE < total_questions:
-            print(f"\n--- 第 {batch_number} 批次處理完畢，休息 {DELAY_BETWEEN_BATCHES} 秒以避免速率超限 ---")
-            await asyncio.sleep(DELAY_BETWEEN_BATCHES)
+            # 如果這不是最後一批，則進行延遲
+            if i + BATCH_SIZE < total_questions:
+                print(f"\n--- 第 {batch_number} 批次處理完畢，休息 {DELAY_BETWEEN_BATCHES} 秒以避免速率超限 ---")
+                await asyncio.sleep(DELAY_BETWEEN_BATCHES)
+    finally:
+        # 釋放檢索程序池 (RETRIEVAL_PROCESSES > 0 時)
+        sut.close()
 
     output_filename = "test_results.json"
     try:
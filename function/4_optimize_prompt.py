@@ -1,5 +1,9 @@
 import os
+import re
+import sys
 import json
+import asyncio
+from collections import Counter
 from dotenv import load_dotenv
 
 # --- 必要的套件引入 ---
@@ -7,64 +11,26 @@ from langchain_core.prompts import ChatPromptTemplate
 from langchain_openai import ChatOpenAI
 from langchain_core.output_parsers import StrOutputParser
 
+# 讓 Python 找到上一層的 sut_system 模組，以取得受測系統實際使用的 Prompt
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from sut_system.main import DEFAULT_PROMPTS
+
 # ==============================================================================
-# --- 設定區：請將您所有需要優化的 Prompt 集中管理在此字典中 ---
+# --- 設定區：需要優化的 Prompt ---
 # ==============================================================================
 # 鍵 (Key): 您為 Prompt 取的描述性名稱，會顯示在最終報告的標題中。
-# 值 (Value): 從 sut_system/main.py 複製過來的完整 Prompt 字串。
-# 您可以隨意在這裡新增、刪除或修改 Prompt。
-
-PROMPTS_TO_OPTIMIZE = {
-    "Extractor Prompt (第一階段：文字提取)": """
-    你的身份是一個自動化的、沒有感情的文字提取機器人。
-    你的唯一任務是：在下方提供的「工作表內容」中，僅找出與「主要查詢的原料名稱」最直接相關的【一個或多個簡短文字片段、句子或列表項】。
-
-    主要查詢的原料名稱：【{material_name_str}】
-    (使用者同時提及的相關詞彙，僅供你理解上下文，不用於提取：{description_keywords_str})
-
-    工作表內容：
-    ```markdown
-    {text}
-    ```
-
-    ---
-    **嚴格輸出規則 (ABSOLUTE RULES):**
-
-    1.  **精確提取**: 只輸出包含「主要查詢的原料名稱」的句子、操作步驟或其非常緊密的上下文。範圍越小越好。
-    2.  **【直接輸出原文】**: 你的輸出**必須**直接就是從「工作表內容」中複製出來的文字，一字不改。
-    3.  **【嚴格禁止】添加任何額外文字**: 你的輸出中，**絕對不允許**包含任何你自己創造的、解釋性的、總結性的文字。
-        -   **錯誤範例 (禁止輸出)**: "根據文件，食鹽在第4點提到..."
-        -   **錯誤範例 (禁止輸出)**: "以下是找到的相關內容："
-        -   **錯誤範例 (禁止輸出)**: "好的，這是關於食鹽的資訊。"
-    4.  **【嚴格禁止】提取元信息**: 絕對禁止包含 '## 工作表: ...' 這種標題，或任何 '製表日期', '製表人' 等頁腳資訊。
-    5.  **找不到內容的處理**: 如果在「工作表內容」中找不到任何與「主要查詢的原料名稱」直接相關的內容，你的唯一輸出**必須**是以下這段固定的文字，不得有任何增減：`NO_DIRECT_CONTENT_FOUND`
-    6.  **輸出格式**: 直接輸出文字即可，不要使用 markdown 的 ` ``` ` 區塊包圍。
-
-    再次強調：你的任務是複製貼上，不是總結或解釋。直接開始輸出你找到的原文片段。
-    """,
-    
-    "Synthesizer Prompt (第二階段：結果整合)": """
-    您是一位SOP內容整理員。您的任務是將下方提供的、已從SOP文件中提取出的、與指定原料相關的【多個獨立的簡短文字片段】，整理成一個【極簡的、統一格式的數字編號列表】。
-    使用者主要查詢的原料名稱為【{material_name}】。(使用者查詢時提及的相關詞彙，供您理解上下文：{characteristics_list})
-    
-    已提取的相關SOP片段 (請將它們視為獨立的資訊點)：
-    ---
-    {combined_extracted_text}
-    ---
-
-    您的任務與輸出要求：
-    1.  **【核心任務】：** 將這些片段中的【每一個獨立的資訊點、操作步驟、或注意事項】整理出來，作為列表中的一個獨立項目。
-    2.  **【格式統一】：** 使用從 1. 開始的數字編號列表。
-    3.  **【原文呈現】：** 盡最大可能【直接使用】提取片段中的【原文表述】。**【嚴格禁止】** 任何形式的改寫、摘要、解釋或歸納。
-    4.  **【極簡輸出】：** 您的最終輸出【必須直接是這個數字編號列表本身】。**【嚴格禁止】** 包含任何前言、標題或結語。
-    5.  如果多個片段資訊重複，請只保留一個最清晰的。
-    6.  使用**繁體中文**。
-    請直接開始輸出列表：
-    """
-    # 如果您有第三個、第四個 Prompt，請直接加在下面
-    # "Another Prompt (第三階段：總結)": """...您的第三個 Prompt 內容..."""
+# 值 (Value): 對應到 sut_system/main.py 中 DEFAULT_PROMPTS 的階段名稱，
+#            用於只將該階段造成的失敗案例送去分析，並供 6_ab_test_prompts.py 將優化後的 Prompt 套回正確階段。
+# 新增階段時，請先在 DEFAULT_PROMPTS 中加入該階段的 Prompt，再於此處加上對應的名稱。
+PROMPT_STAGES = {
+    "Extractor Prompt (第一階段：文字提取)": "extraction",
+    "Synthesizer Prompt (第二階段：結果整合)": "synthesis",
 }
 
+# 要優化的 Prompt 原文直接取自受測系統實際使用的 DEFAULT_PROMPTS，
+# 確保優化建議與 A/B 測試的基準版本來自同一份 Prompt。
+PROMPTS_TO_OPTIMIZE = {name: DEFAULT_PROMPTS[stage] for name, stage in PROMPT_STAGES.items()}
+
 # --- 函式定義 (與之前相同，無需修改) ---
 
 def initialize_llm():
@@ -106,22 +72,28 @@ def filter_poor_performing_cases(report, threshold=0.9):
     print(f"篩選出 {len(poor_cases)} 個表現不佳的案例 (分數低於 {threshold})。")
     return poor_cases
 
-def generate_prompt_suggestions(llm, original_prompt, failure_cases):
-    if not failure_cases:
-        return "所有案例表現良好，無需優化！"
-    
-    cases_for_analysis = failure_cases[:5] # 為了避免 Prompt 過長，只選前 5 個
-    failure_analysis_str = ""
-    for i, case in enumerate(cases_for_analysis):
-        failure_analysis_str += f"--- 失敗案例 {i+1} ---\n"
-        failure_analysis_str += f"問題: {case.get('question')}\n"
-        failure_analysis_str += f"黃金答案 (期望的): {case.get('golden_answer')}\n"
-        failure_analysis_str += f"系統的錯誤答案: {case.get('actual_answer')}\n"
-        failure_analysis_str += f"AI評審員的評語: {json.dumps(case.get('evaluation'), ensure_ascii=False)}\n\n"
-
-    prompt_template_str = """
+# --- 失敗案例分群與取樣的設定 ---
+FAILURE_CASES_TOKEN_BUDGET = 6000   # 單次分析呼叫中，失敗案例內容可使用的 token 預算
+CLUSTER_SIMILARITY_THRESHOLD = 0.3  # 兩個案例的評語相似度 (字元 bigram 的 Jaccard 係數) 達此值即歸為同一群
+EXTRACTION_COVERAGE_THRESHOLD = 0.6 # 提取結果涵蓋黃金答案的比例達此值，即視為提取成功、失敗發生在整合階段
+ANALYSIS_CONCURRENCY = 3            # 所有 Prompt 合計同時進行的分析呼叫數 (避免 Map 階段瞬間發出大量呼叫而觸發速率限制)
+ANALYSIS_MAX_ATTEMPTS = 3           # 單次分析呼叫失敗時的最多嘗試次數
+ANALYSIS_RETRY_DELAY = 5            # 重試前的等待秒數 (每次重試加倍)
+
+# 失敗階段的顯示名稱 (None 表示測試結果中沒有 trace 紀錄，無法判斷)
+FAILURE_STAGE_LABELS = {
+    "keyword_extraction": "關鍵字提取",
+    "section_search": "區塊搜尋",
+    "extraction": "第一階段：文字提取",
+    "synthesis": "第二階段：結果整合",
+    "error": "執行錯誤",
+    None: "無階段紀錄 (舊格式測試結果)",
+}
+
+SUGGESTION_PROMPT_TEMPLATE = """
     你的身份是一位世界頂尖的提示工程 (Prompt Engineering) 專家。
     一個 RAG (檢索增強生成) 系統在回答問題時表現不佳，你的任務是分析一系列失敗案例，並對系統使用的【原始 Prompt】提出具體的、可執行的修改建議。
+    失敗案例已依據失敗原因的相似程度分群，每一群只列出具代表性的案例，並標示該群的案例總數，請優先處理案例數多的類型。
 
     **你的分析目標：【原始 Prompt】**
     ```text
@@ -143,46 +115,307 @@ def generate_prompt_suggestions(llm, original_prompt, failure_cases):
     ### 3. 優化後的完整 Prompt (Optimized Full Prompt)
     - 提供一個整合了你所有建議的、可以直接複製使用的【優化後完整 Prompt 版本】。
     """
-    
-    prompt = ChatPromptTemplate.from_template(prompt_template_str)
+
+# (Map 階段) 失敗案例過多時，先針對其中一部分失敗類型做精簡分析
+MAP_PROMPT_TEMPLATE = """
+    你的身份是一位世界頂尖的提示工程 (Prompt Engineering) 專家。
+    一個 RAG (檢索增強生成) 系統在回答問題時表現不佳。失敗案例太多，已分批交給多位專家分析，你負責其中一批。
+    失敗案例已依據失敗原因的相似程度分群，每一群只列出具代表性的案例，並標示該群的案例總數。
+
+    **系統使用的【原始 Prompt】**
+    ```text
+    {original_prompt}
+    ```
+
+    **你負責的失敗案例：**
+    {failure_cases_str}
+
+    **你的任務與輸出要求：**
+    請針對這一批失敗類型，以條列方式精簡輸出 (總長度不超過 400 字)：
+    - 每一種失敗類型對應的【原始 Prompt】問題根源，並註明該類型的案例數。
+    - 對應的具體修改建議，例如「將 A 句修改為 B 句」。
+    不需要輸出完整的優化後 Prompt。
+    """
+
+# (Reduce 階段) 將各批的分析結果合併成最終的完整報告
+REDUCE_PROMPT_TEMPLATE = """
+    你的身份是一位世界頂尖的提示工程 (Prompt Engineering) 專家。
+    一個 RAG (檢索增強生成) 系統在回答問題時表現不佳。多位專家已分別分析了不同批次的失敗案例，你的任務是整合他們的分析，對【原始 Prompt】提出最終的修改方案。
+    若不同專家的建議互相衝突，請以涉及案例數較多的建議為優先。
+
+    **你的分析目標：【原始 Prompt】**
+    ```text
+    {original_prompt}
+    ```
+
+    **各批次的分析結果：**
+    {partial_analyses_str}
+
+    **你的任務與輸出要求：**
+    請基於以上所有資訊，產出一份【Prompt 優化報告】。報告必須包含以下三個部分，並使用 Markdown 標題格式化：
+
+    ### 1. 問題根源分析 (Root Cause Analysis)
+    - 整合各批次的分析，說明【原始 Prompt】中可能存在哪些模糊、有歧義或有漏洞的指令，導致了失敗。
+
+    ### 2. 具體修改建議 (Actionable Suggestions)
+    - 提出清晰的修改建議，例如「將 A 句修改為 B 句」。
+
+    ### 3. 優化後的完整 Prompt (Optimized Full Prompt)
+    - 提供一個整合了你所有建議的、可以直接複製使用的【優化後完整 Prompt 版本】。
+    """
+
+def _estimate_tokens(text):
+    """粗估文字的 token 數 (中文約 1 字 1 token，直接以字元數保守估計)。"""
+    return len(text)
+
+def _char_bigrams(text):
+    """將文字 (去除空白後) 轉為字元 bigram 集合，作為相似度比對的依據。"""
+    text = re.sub(r'\s+', '', text or "")
+    if len(text) < 2:
+        return {text} if text else set()
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+def _jaccard_similarity(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+def cluster_failure_cases(failure_cases, threshold=CLUSTER_SIMILARITY_THRESHOLD):
+    """
+    依 AI 評審員的評語 (缺少時改用問題本身) 的字元 bigram 相似度，以貪婪法將失敗案例分群。
+    每一群的第一個案例即為該群的代表案例；回傳的群組依案例數由多到少排序。
+    """
+    clusters = []
+    for case in failure_cases:
+        evaluation = case.get("evaluation") if isinstance(case.get("evaluation"), dict) else {}
+        signature = _char_bigrams(evaluation.get("explanation") or case.get("question"))
+        best_cluster, best_similarity = None, 0.0
+        for cluster in clusters:
+            similarity = _jaccard_similarity(signature, cluster["signature"])
+            if similarity > best_similarity:
+                best_cluster, best_similarity = cluster, similarity
+        if best_cluster is not None and best_similarity >= threshold:
+            best_cluster["cases"].append(case)
+        else:
+            clusters.append({"signature": signature, "cases": [case]})
+    clusters.sort(key=lambda cluster: len(cluster["cases"]), reverse=True)
+    return [cluster["cases"] for cluster in clusters]
+
+def attribute_failure_stage(case):
+    """
+    依測試時記錄的中間產物 (trace) 判斷失敗發生在哪個階段，回傳 FAILURE_STAGE_LABELS 中的鍵。
+    若提取結果已涵蓋黃金答案的大部分內容，代表提取成功、問題出在整合階段；反之則歸因於提取階段。
+    """
+    trace = case.get("trace")
+    if not isinstance(trace, dict):
+        return None
+    if trace.get("error"):
+        return "error"
+    if not (trace.get("keywords") or {}).get("原料名稱"):
+        return "keyword_extraction"
+    if not trace.get("matched_sections"):
+        return "section_search"
+    extractions = trace.get("extractions") or []
+    if extractions and all(item.get("error") for item in extractions):
+        return "error"
+    extracted_text = "".join(item.get("text", "") for item in extractions if item.get("found"))
+    golden_bigrams = _char_bigrams(case.get("golden_answer"))
+    if not golden_bigrams:
+        return "extraction"
+    coverage = len(golden_bigrams & _char_bigrams(extracted_text)) / len(golden_bigrams)
+    return "synthesis" if coverage >= EXTRACTION_COVERAGE_THRESHOLD else "extraction"
+
+def assign_cases_to_prompts(poor_cases):
+    """
+    依失敗階段將案例分配給對應的 Prompt，回傳 ({Prompt 名稱: 案例列表}, 各階段案例數)。
+    檢索階段的失敗與執行錯誤與 Prompt 無關，不送入分析；沒有 trace 的舊資料則分配給所有 Prompt。
+    """
+    cases_by_prompt = {prompt_name: [] for prompt_name in PROMPTS_TO_OPTIMIZE}
+    stage_counts = Counter()
+    for case in poor_cases:
+        stage = attribute_failure_stage(case)
+        stage_counts[stage] += 1
+        for prompt_name in PROMPTS_TO_OPTIMIZE:
+            # 未在 PROMPT_STAGES 設定階段的 Prompt，一律接收所有案例
+            if stage is None or PROMPT_STAGES.get(prompt_name) in (None, stage):
+                cases_by_prompt[prompt_name].append(case)
+    return cases_by_prompt, stage_counts
+
+def format_stage_summary(stage_counts):
+    """將各失敗階段的案例數格式化為 Markdown 段落。"""
+    lines = ["# 失敗階段歸因", "", "| 失敗階段 | 案例數 |", "|---|---|"]
+    for stage, label in FAILURE_STAGE_LABELS.items():
+        if stage_counts.get(stage):
+            lines.append(f"| {label} | {stage_counts[stage]} |")
+    retrieval_failures = stage_counts.get("keyword_extraction", 0) + stage_counts.get("section_search", 0)
+    if retrieval_failures:
+        lines.append("")
+        lines.append(f"其中 {retrieval_failures} 個案例失敗於檢索階段 (未使用 LLM)，未送入 Prompt 分析，請檢查斷詞與區塊搜尋邏輯。")
+    return "\n".join(lines)
+
+def _format_case(case, case_number):
+    case_str = f"--- 失敗案例 {case_number} ---\n"
+    case_str += f"問題: {case.get('question')}\n"
+    case_str += f"黃金答案 (期望的): {case.get('golden_answer')}\n"
+    trace = case.get("trace")
+    if isinstance(trace, dict):
+        # 附上第一階段實際提取到的內容，讓分析者能分辨是「沒提取到」還是「提取到卻沒整合好」
+        found_texts = [item.get("text", "") for item in trace.get("extractions") or [] if item.get("found")]
+        case_str += f"命中的工作表: {'、'.join(trace.get('matched_sections') or []) or '無'}\n"
+        case_str += f"第一階段提取結果: {' / '.join(found_texts) or '未提取到任何內容'}\n"
+    case_str += f"系統的錯誤答案: {case.get('actual_answer')}\n"
+    case_str += f"AI評審員的評語: {json.dumps(case.get('evaluation'), ensure_ascii=False)}\n\n"
+    return case_str
+
+def format_failure_clusters(clusters, token_budget=FAILURE_CASES_TOKEN_BUDGET):
+    """
+    以輪流的方式從每一群挑選案例 (先挑各群的代表案例，再挑第二個，依此類推)，
+    直到用完 token 預算，並依群組格式化為分析用的文字。
+    """
+    selected = [[] for _ in clusters]
+    used_tokens = 0
+    selected_count = 0
+    budget_exhausted = False
+    for round_index in range(max(len(cluster) for cluster in clusters)):
+        for cluster_index, cluster in enumerate(clusters):
+            if round_index >= len(cluster):
+                continue
+            cost = _estimate_tokens(_format_case(cluster[round_index], selected_count + 1))
+            # 至少保留一個案例，避免單一案例就超出預算時完全沒有內容可分析
+            if used_tokens + cost > token_budget and selected_count > 0:
+                budget_exhausted = True
+                break
+            selected[cluster_index].append(cluster[round_index])
+            used_tokens += cost
+            selected_count += 1
+        if budget_exhausted:
+            break
+
+    failure_analysis_str = ""
+    case_number = 0
+    for cluster_index, cluster in enumerate(clusters):
+        if not selected[cluster_index]:
+            continue
+        failure_analysis_str += f"=== 失敗類型 {cluster_index + 1} (共 {len(cluster)} 個相似案例，以下列出 {len(selected[cluster_index])} 個代表) ===\n"
+        for case in selected[cluster_index]:
+            case_number += 1
+            failure_analysis_str += _format_case(case, case_number)
+    return failure_analysis_str
+
+def _group_clusters_by_budget(clusters, token_budget=FAILURE_CASES_TOKEN_BUDGET):
+    """將群組依序切分成多批，使每一批中各群的代表案例合計不超過 token 預算 (供 Map-Reduce 使用)。"""
+    groups = [[]]
+    used_tokens = 0
+    for cluster in clusters:
+        cost = _estimate_tokens(_format_case(cluster[0], 1))
+        if groups[-1] and used_tokens + cost > token_budget:
+            groups.append([])
+            used_tokens = 0
+        groups[-1].append(cluster)
+        used_tokens += cost
+    return groups
+
+async def _invoke_prompt_async(llm, template, **inputs):
+    prompt = ChatPromptTemplate.from_template(template)
     chain = prompt | llm | StrOutputParser()
-    
-    try:
-        suggestion_report = chain.invoke({
-            "original_prompt": original_prompt,
-            "failure_cases_str": failure_analysis_str
-        })
-        return suggestion_report
-    except Exception as e:
-        print(f"❌ 生成優化建議時出錯: {e}")
-        return f"生成建議失敗: {e}"
+    return await chain.ainvoke(inputs)
 
-# --- 主執行區塊 (已重構為可擴展) ---
-def main():
+async def _invoke_with_retry_async(llm, semaphore, description, template, **inputs):
+    """在 semaphore 限制下呼叫 LLM，失敗時依 ANALYSIS_RETRY_DELAY 退避重試；全部失敗則回傳 None。"""
+    for attempt in range(1, ANALYSIS_MAX_ATTEMPTS + 1):
+        try:
+            async with semaphore:
+                return await _invoke_prompt_async(llm, template, **inputs)
+        except Exception as e:
+            print(f"⚠️ {description}失敗 (第 {attempt}/{ANALYSIS_MAX_ATTEMPTS} 次): {e}")
+            if attempt < ANALYSIS_MAX_ATTEMPTS:
+                await asyncio.sleep(ANALYSIS_RETRY_DELAY * 2 ** (attempt - 1))
+    return None
+
+async def generate_prompt_suggestions_async(llm, original_prompt, failure_cases, semaphore=None):
     """
-    主執行流程，現在會自動遍歷 PROMPTS_TO_OPTIMIZE 字典中的所有 Prompt。
+    (非同步) 分析所有失敗案例並產生 Prompt 優化報告。
+    失敗案例先分群並在 token 預算內挑選代表案例；若單批放不下所有失敗類型，則以 Map-Reduce 分批分析後再整合。
+    semaphore 限制同時進行的分析呼叫數 (多個 Prompt 同時分析時應共用同一個)；
+    個別批次重試後仍失敗時只略過該批，以其餘批次的分析結果產出報告。
     """
-    llm_instance = initialize_llm()
-    if not llm_instance: return
+    if not failure_cases:
+        return "所有案例表現良好，無需優化！"
+    semaphore = semaphore or asyncio.Semaphore(ANALYSIS_CONCURRENCY)
 
-    report = load_evaluation_report()
-    if not report: return
+    clusters = cluster_failure_cases(failure_cases)
+    groups = _group_clusters_by_budget(clusters)
+    print(f"   {len(failure_cases)} 個失敗案例分為 {len(clusters)} 種失敗類型，共 {len(groups)} 批進行分析。")
 
-    poor_cases = filter_poor_performing_cases(report)
-    if not poor_cases:
-        print("\n🎉 恭喜！所有測試案例的評分均高於閾值，目前無需優化。")
-        return
+    if len(groups) == 1:
+        suggestion = await _invoke_with_retry_async(
+            llm, semaphore, "分析失敗案例",
+            SUGGESTION_PROMPT_TEMPLATE,
+            original_prompt=original_prompt,
+            failure_cases_str=format_failure_clusters(clusters)
+        )
+        return suggestion if suggestion is not None else "生成建議失敗：分析呼叫重試後仍未成功，請稍後重新執行。"
 
-    # 建立一個列表來存放所有報告內容
-    all_reports_content = []
+    # Map：各批失敗類型在並行上限內同時分析
+    partial_analyses = await asyncio.gather(*(
+        _invoke_with_retry_async(
+            llm, semaphore, f"第 {i+1} 批分析",
+            MAP_PROMPT_TEMPLATE,
+            original_prompt=original_prompt,
+            failure_cases_str=format_failure_clusters(group)
+        )
+        for i, group in enumerate(groups)
+    ))
+    # Reduce：只整合成功的批次，並記錄未納入的批次
+    partial_analyses_str = ""
+    failed_case_count = 0
+    for i, (group, analysis) in enumerate(zip(groups, partial_analyses)):
+        case_count = sum(len(cluster) for cluster in group)
+        if analysis is None:
+            failed_case_count += case_count
+            continue
+        partial_analyses_str += f"--- 第 {i+1} 批分析 (涵蓋 {case_count} 個失敗案例) ---\n{analysis}\n\n"
+    if not partial_analyses_str:
+        return "生成建議失敗：所有批次的分析呼叫重試後仍未成功，請稍後重新執行。"
 
-    # 遍歷字典中的每一個 Prompt 進行分析
-    for prompt_name, prompt_content in PROMPTS_TO_OPTIMIZE.items():
-        print(f"\n{'='*20}\n analyzing Prompt: '{prompt_name}'\n{'='*20}")
-        
-        suggestion = generate_prompt_suggestions(llm_instance, prompt_content, poor_cases)
-        
-        # 將每個 Prompt 的分析報告格式化後加入列表
+    failed_note = ""
+    if failed_case_count:
+        failed_groups = sum(1 for analysis in partial_analyses if analysis is None)
+        failed_note = f"\n\n(註：有 {failed_groups} 批分析失敗，其涵蓋的 {failed_case_count} 個失敗案例未納入本報告。)"
+    report = await _invoke_with_retry_async(
+        llm, semaphore, "整合各批分析",
+        REDUCE_PROMPT_TEMPLATE,
+        original_prompt=original_prompt,
+        partial_analyses_str=partial_analyses_str
+    )
+    if report is None:
+        # 整合失敗時，至少保留各批的分析結果
+        return f"(整合各批分析失敗，以下為各批的原始分析結果)\n\n{partial_analyses_str.strip()}{failed_note}"
+    return report + failed_note
+
+async def build_optimization_report_async(llm, poor_cases):
+    """
+    (非同步) 依失敗階段將案例分配給 PROMPTS_TO_OPTIMIZE 中對應的 Prompt 並同時分析，
+    產生合併後的綜合優化報告內容 (開頭附上失敗階段歸因摘要)。
+    """
+    cases_by_prompt, stage_counts = assign_cases_to_prompts(poor_cases)
+    for stage, label in FAILURE_STAGE_LABELS.items():
+        if stage_counts.get(stage):
+            print(f"   失敗階段「{label}」：{stage_counts[stage]} 個案例")
+
+    prompts_to_analyze = [prompt_name for prompt_name, cases in cases_by_prompt.items() if cases]
+    print(f"\n{'='*20}\n analyzing {len(prompts_to_analyze)} Prompts concurrently: {prompts_to_analyze}\n{'='*20}")
+    semaphore = asyncio.Semaphore(ANALYSIS_CONCURRENCY)
+    suggestions = await asyncio.gather(*(
+        generate_prompt_suggestions_async(llm, PROMPTS_TO_OPTIMIZE[prompt_name], cases_by_prompt[prompt_name], semaphore)
+        for prompt_name in prompts_to_analyze
+    ))
+    suggestion_by_prompt = dict(zip(prompts_to_analyze, suggestions))
+
+    # 將每個 Prompt 的分析報告格式化後加入列表
+    all_reports_content = [format_stage_summary(stage_counts)]
+    for prompt_name in PROMPTS_TO_OPTIMIZE:
+        suggestion = suggestion_by_prompt.get(prompt_name, "沒有歸因到此階段的失敗案例，無需優化。")
         report_section = f"""
 # {prompt_name} - 優化報告
 
@@ -190,10 +423,11 @@ def main():
 """
         all_reports_content.append(report_section)
 
-    # 將所有報告合併成一個檔案
-    full_report_content = "\n---\n".join(all_reports_content)
-    output_filename = "prompt_optimization_report_full.md"
-    
+    # 將所有報告合併成一份內容
+    return "\n---\n".join(all_reports_content)
+
+def save_optimization_report(full_report_content, output_filename="prompt_optimization_report_full.md"):
+    """將綜合優化報告寫入 Markdown 檔案。"""
     try:
         with open(output_filename, 'w', encoding='utf-8') as f:
             f.write(full_report_content.strip())
@@ -201,5 +435,24 @@ def main():
     except Exception as e:
         print(f"❌ 儲存綜合報告時發生錯誤：{e}")
 
+# --- 主執行區塊 (已重構為可擴展) ---
+async def main():
+    """
+    主執行流程，現在會同時分析 PROMPTS_TO_OPTIMIZE 字典中的所有 Prompt。
+    """
+    llm_instance = initialize_llm()
+    if not llm_instance: return
+
+    report = load_evaluation_report()
+    if not report: return
+
+    poor_cases = filter_poor_performing_cases(report)
+    if not poor_cases:
+        print("\n🎉 恭喜！所有測試案例的評分均高於閾值，目前無需優化。")
+        return
+
+    full_report_content = await build_optimization_report_async(llm_instance, poor_cases)
+    save_optimization_report(full_report_content)
+
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
@@ -0,0 +1,176 @@
+import os
+import sys
+import json
+import asyncio
+import importlib
+import time
+from dotenv import load_dotenv
+
+# --- 必要的套件引入 ---
+from langchain_openai import ChatOpenAI
+from langchain_core.rate_limiters import InMemoryRateLimiter
+
+# 讓 Python 找到同資料夾的各階段腳本，以及上一層的 sut_system 模組
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# 各階段腳本的檔名以數字開頭，無法直接使用 import 語法，改用 importlib 引入
+generate_stage = importlib.import_module("1_generate_qa")
+run_stage = importlib.import_module("2_run_tests")
+evaluate_stage = importlib.import_module("3_evaluate_results")
+optimize_stage = importlib.import_module("4_optimize_prompt")
+
+# --- 設定區：控制各階段的並行數量，以及所有階段共用的 LLM 請求速率 ---
+GENERATE_CONCURRENCY = 4   # 同時生成 Q&A 的文件區塊數
+RUN_CONCURRENCY = 4        # 同時對受測系統提問的問題數
+EVALUATE_CONCURRENCY = 4   # 同時評估的測試結果數
+REQUESTS_PER_SECOND = 5    # 所有階段合計每秒最多送出的 LLM 請求數
+
+# 佇列的結束標記：上游階段全部送完後放入，通知下游 worker 收工
+_STAGE_DONE = object()
+
+def initialize_shared_llm():
+    """載入環境變數，建立所有階段共用的 ChatOpenAI 物件，並以同一個速率限制器統一排程請求。"""
+    load_dotenv()
+    api_key = os.getenv("OPENAI_API_KEY")
+    model_name = os.getenv("MODEL_NAME", "gpt-4o-mini")
+    if not api_key:
+        print("❌ 錯誤：找不到 OPENAI_API_KEY。")
+        return None
+    try:
+        rate_limiter = InMemoryRateLimiter(
+            requests_per_second=REQUESTS_PER_SECOND,
+            check_every_n_seconds=0.05,
+            max_bucket_size=REQUESTS_PER_SECOND
+        )
+        llm = ChatOpenAI(model=model_name, openai_api_key=api_key, rate_limiter=rate_limiter)
+        print(f"✅ 共用 LLM ({model_name}) 初始化成功，速率上限 {REQUESTS_PER_SECOND} 次/秒。")
+        return llm
+    except Exception as e:
+        print(f"❌ LLM 初始化失敗：{e}")
+        return None
+
+def save_json(data, output_filename):
+    """將資料寫入 JSON 檔案。"""
+    try:
+        with open(output_filename, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
+        print(f"✅ 已儲存 '{output_filename}' (共 {len(data)} 筆)。")
+    except Exception as e:
+        print(f"❌ 儲存 '{output_filename}' 時發生錯誤：{e}")
+
+async def run_workers(worker_count, in_queue, handle_item):
+    """啟動多個 worker 從佇列取出項目交給 handle_item 處理，直到收到結束標記。"""
+    async def worker():
+        while True:
+            item = await in_queue.get()
+            if item is _STAGE_DONE:
+                # 把結束標記放回佇列，讓其他 worker 也能收到
+                await in_queue.put(_STAGE_DONE)
+                return
+            await handle_item(item)
+
+    await asyncio.gather(*(worker() for _ in range(worker_count)))
+
+async def generate_stage_async(llm, sections, qa_queue, dataset):
+    """(階段 1) 並行為每個區塊生成 Q&A，每生成一組就立刻送進下一階段的佇列。"""
+    semaphore = asyncio.Semaphore(GENERATE_CONCURRENCY)
+
+    async def generate_for_section(section):
+        async with semaphore:
+            result = await generate_stage.generate_qa_for_section_async(llm, section['content'])
+        if result and 'qa_pairs' in result:
+            for qa_pair in result['qa_pairs']:
+                qa_pair['source_section'] = section['title']
+                index = len(dataset)
+                dataset.append(qa_pair)
+                await qa_queue.put((index, qa_pair))
+
+    await asyncio.gather(*(generate_for_section(section) for section in sections))
+    print(f"\n--- (階段 1) Q&A 生成完畢，共 {len(dataset)} 組 ---")
+    await qa_queue.put(_STAGE_DONE)
+
+async def run_stage_async(sut, qa_queue, eval_queue, test_results):
+    """(階段 2) 從佇列取出問題對受測系統提問，完成後立刻送進評估佇列。"""
+    async def handle_item(item):
+        index, qa_pair = item
+        # 串流模式下無法事先得知題目總數，以 "?" 代替
+        result = await run_stage.run_single_test(sut, qa_pair, index, "?")
+        if result is not None:
+            test_results[index] = result
+            await eval_queue.put((index, result))
+
+    await run_workers(RUN_CONCURRENCY, qa_queue, handle_item)
+    print(f"\n--- (階段 2) 測試執行完畢，共 {len(test_results)} 筆 ---")
+    await eval_queue.put(_STAGE_DONE)
+
+async def evaluate_stage_async(llm, eval_queue, evaluation_reports):
+    """(階段 3) 從佇列取出測試結果進行評估。"""
+    async def handle_item(item):
+        index, test_result = item
+        evaluation_reports[index] = await evaluate_stage.evaluate_single_answer_async(llm, test_result)
+
+    await run_workers(EVALUATE_CONCURRENCY, eval_queue, handle_item)
+    print(f"\n--- (階段 3) 評估完畢，共 {len(evaluation_reports)} 筆 ---")
+
+async def main():
+    """
+    主執行流程：在單一程序內以非同步佇列串接「生成 → 提問 → 評估」，
+    各階段同時進行，最後再執行 Prompt 優化並一次寫出所有產出檔案。
+    """
+    pipeline_start = time.time()
+
+    llm_instance = initialize_shared_llm()
+    if not llm_instance:
+        return
+
+    sections = generate_stage.load_and_split_document()
+    if not sections:
+        return
+
+    print("\n--- 正在初始化受測系統 (SOPQuerySystem，共用 LLM) ---")
+    sut = run_stage.SOPQuerySystem(llm=llm_instance)
+    if not sut.initialization_success:
+        print("❌ 受測系統初始化失敗，流程中止。")
+        return
+
+    qa_queue = asyncio.Queue()
+    eval_queue = asyncio.Queue()
+    dataset = []
+    test_results = {}
+    evaluation_reports = {}
+
+    print(f"\n⏳ 開始串流執行：{len(sections)} 個文件區塊將依序流經生成、提問與評估階段...")
+    try:
+        await asyncio.gather(
+            generate_stage_async(llm_instance, sections, qa_queue, dataset),
+            run_stage_async(sut, qa_queue, eval_queue, test_results),
+            evaluate_stage_async(llm_instance, eval_queue, evaluation_reports)
+        )
+    finally:
+        # 之後的階段不再需要受測系統，先釋放檢索程序池 (RETRIEVAL_PROCESSES > 0 時)
+        sut.close()
+
+    # 各階段的完成順序不固定，依生成順序重新排列後再寫出
+    ordered_results = [test_results[i] for i in sorted(test_results)]
+    ordered_reports = [evaluation_reports[i] for i in sorted(evaluation_reports)]
+
+    print("\n--- 正在寫出各階段產出檔案 ---")
+    save_json(dataset, "test_dataset.json")
+    save_json(ordered_results, "test_results.json")
+    save_json(ordered_reports, "evaluation_report.json")
+
+    # (階段 4) Prompt 優化需要完整的失敗案例，因此在前三階段結束後才執行
+    poor_cases = optimize_stage.filter_poor_performing_cases(ordered_reports)
+    if poor_cases:
+        # 與 4_optimize_prompt.py 相同使用較高的溫度，但仍共用同一個 LLM 物件與速率限制器
+        optimizer_llm = llm_instance.bind(temperature=0.5)
+        full_report_content = await optimize_stage.build_optimization_report_async(optimizer_llm, poor_cases)
+        optimize_stage.save_optimization_report(full_report_content)
+    else:
+        print("\n🎉 恭喜！所有測試案例的評分均高於閾值，目前無需優化。")
+
+    print(f"\n\n🎉 完整流程執行完畢，總耗時 {time.time() - pipeline_start:.2f} 秒。")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,244 @@
+import os
+import re
+import sys
+import json
+import asyncio
+import importlib
+import statistics
+import time
+
+# --- 必要的套件引入 ---
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.callbacks import UsageMetadataCallbackHandler
+
+# 讓 Python 找到同資料夾的各階段腳本，以及上一層的 sut_system 模組
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from metrics import percentile
+
+# 各階段腳本的檔名以數字開頭，無法直接使用 import 語法，改用 importlib 引入
+run_stage = importlib.import_module("2_run_tests")
+evaluate_stage = importlib.import_module("3_evaluate_results")
+optimize_stage = importlib.import_module("4_optimize_prompt")
+from sut_system.main import DEFAULT_PROMPTS
+
+# ==============================================================================
+# --- 設定區 ---
+# ==============================================================================
+# 候選 Prompt 版本檔 (JSON)：鍵為版本名稱，值為 {階段名稱: Prompt 樣板}，未列出的階段沿用預設 Prompt。
+# 例如：{"v2-嚴格提取": {"extraction": "..."}, "v3-雙階段": {"extraction": "...", "synthesis": "..."}}
+# 若此檔案不存在，則自動從 4_optimize_prompt.py 產出的報告中擷取「優化後的完整 Prompt」作為候選版本。
+VARIANTS_FILE = "prompt_variants.json"
+OPTIMIZATION_REPORT_FILE = "prompt_optimization_report_full.md"
+
+MAX_CONCURRENT_QUERIES = 8  # 所有版本合計同時進行的查詢數
+PASS_THRESHOLD = 0.9        # 準確度與完整度皆達此分數才算通過 (與 4_optimize_prompt.py 的篩選門檻一致)
+
+BASELINE_VARIANT_NAME = "baseline (目前的 Prompt)"
+
+def _extract_optimized_prompt(suggestion_text):
+    """從單一 Prompt 的優化報告中，擷取「### 3. 優化後的完整 Prompt」段落內的 Prompt 原文。"""
+    match = re.search(r'^###\s*3\..*$', suggestion_text, flags=re.MULTILINE)
+    if not match:
+        return None
+    lines = suggestion_text[match.end():].strip().splitlines()
+    # Prompt 本身可能含有 ```markdown 區塊，因此取「第一個」與「最後一個」圍欄之間的全部內容
+    fence_lines = [i for i, line in enumerate(lines) if line.strip().startswith("```")]
+    if len(fence_lines) >= 2:
+        lines = lines[fence_lines[0] + 1:fence_lines[-1]]
+    optimized_prompt = "\n".join(lines).strip()
+    return optimized_prompt or None
+
+def load_variants_from_report(file_path=OPTIMIZATION_REPORT_FILE):
+    """解析 Prompt 優化報告，為每個優化後的 Prompt 建立單獨版本，並另建一個全部套用的組合版本。"""
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            report_content = f.read()
+    except FileNotFoundError:
+        print(f"❌ 錯誤：找不到 '{VARIANTS_FILE}' 或優化報告 '{file_path}'。請先執行 4_optimize_prompt.py。")
+        return {}
+
+    headers = list(re.finditer(r'^# (.+?) - 優化報告\s*$', report_content, flags=re.MULTILINE))
+    variants = {}
+    combined = {}
+    for i, header in enumerate(headers):
+        prompt_name = header.group(1).strip()
+        stage = optimize_stage.PROMPT_STAGES.get(prompt_name)
+        if not stage:
+            print(f"⚠️ 警告：Prompt '{prompt_name}' 沒有對應的受測系統階段，略過。")
+            continue
+        section_end = headers[i + 1].start() if i + 1 < len(headers) else len(report_content)
+        optimized_prompt = _extract_optimized_prompt(report_content[header.end():section_end])
+        if not optimized_prompt:
+            print(f"⚠️ 警告：無法從報告中擷取 '{prompt_name}' 的優化後 Prompt，略過。")
+            continue
+        variants[f"optimized-{stage}"] = {stage: optimized_prompt}
+        combined[stage] = optimized_prompt
+
+    if len(combined) > 1:
+        variants["optimized-all"] = combined
+    print(f"✅ 從優化報告 '{file_path}' 擷取出 {len(variants)} 個候選版本。")
+    return variants
+
+def load_variants():
+    """載入候選 Prompt 版本；優先使用 VARIANTS_FILE，否則從優化報告擷取。基準版本一律加入。"""
+    if os.path.exists(VARIANTS_FILE):
+        try:
+            with open(VARIANTS_FILE, 'r', encoding='utf-8') as f:
+                variants = json.load(f)
+            print(f"✅ 成功載入候選版本檔 '{VARIANTS_FILE}'，共 {len(variants)} 個版本。")
+        except Exception as e:
+            print(f"❌ 讀取候選版本檔時發生錯誤：{e}")
+            return {}
+    else:
+        variants = load_variants_from_report()
+
+    valid_variants = {BASELINE_VARIANT_NAME: {}}
+    for name, overrides in variants.items():
+        if _validate_overrides(name, overrides):
+            valid_variants[name] = overrides
+    return valid_variants
+
+def _validate_overrides(variant_name, overrides):
+    """檢查候選 Prompt 的階段名稱與樣板變數，避免執行到一半才因缺少變數而失敗。"""
+    for stage, template in overrides.items():
+        if stage not in DEFAULT_PROMPTS:
+            print(f"⚠️ 警告：版本 '{variant_name}' 含有未知的階段 '{stage}'，略過此版本。")
+            return False
+        try:
+            used_variables = set(ChatPromptTemplate.from_template(template).input_variables)
+        except Exception as e:
+            print(f"⚠️ 警告：版本 '{variant_name}' 的 '{stage}' Prompt 無法解析 ({e})，略過此版本。")
+            return False
+        allowed_variables = set(ChatPromptTemplate.from_template(DEFAULT_PROMPTS[stage]).input_variables)
+        unknown_variables = used_variables - allowed_variables
+        if unknown_variables:
+            print(f"⚠️ 警告：版本 '{variant_name}' 的 '{stage}' Prompt 使用了未知變數 {sorted(unknown_variables)}，略過此版本。")
+            return False
+    return True
+
+async def run_variant_query(variant_name, variant_sut, qa_pair, semaphore, evaluate_cached):
+    """(非同步) 以指定版本回答單一問題並評估，回傳包含延遲與評分的結果。"""
+    question = qa_pair.get("question")
+    async with semaphore:
+        start_time = time.perf_counter()
+        actual_answer = await variant_sut.process_query(question)
+        latency = time.perf_counter() - start_time
+
+    test_result = {
+        "question": question,
+        "golden_answer": qa_pair.get("golden_answer"),
+        "actual_answer": actual_answer
+    }
+    evaluated = await evaluate_cached(test_result)
+    return {"variant": variant_name, "latency": latency, **evaluated}
+
+def summarize_variant(variant_name, results, usage_callback):
+    """彙整單一版本的分數、延遲與 token 用量。"""
+    scores = [r["evaluation"] for r in results if isinstance(r.get("evaluation"), dict) and "error" not in r["evaluation"]]
+    latencies = [r["latency"] for r in results]
+    passed = [s for s in scores if s.get("accuracy_score", 0) >= PASS_THRESHOLD and s.get("completeness_score", 0) >= PASS_THRESHOLD]
+    usage = usage_callback.usage_metadata.values()
+    return {
+        "variant": variant_name,
+        "questions": len(results),
+        "evaluated": len(scores),
+        "mean_accuracy": statistics.mean(s.get("accuracy_score", 0) for s in scores) if scores else 0.0,
+        "mean_completeness": statistics.mean(s.get("completeness_score", 0) for s in scores) if scores else 0.0,
+        "pass_rate": len(passed) / len(scores) if scores else 0.0,
+        "mean_latency": statistics.mean(latencies) if latencies else 0.0,
+        "p95_latency": percentile(latencies, 95),
+        "input_tokens": sum(u.get("input_tokens", 0) for u in usage),
+        "output_tokens": sum(u.get("output_tokens", 0) for u in usage)
+    }
+
+def format_summary_table(summaries):
+    """將各版本的彙整結果格式化為 Markdown 表格。"""
+    lines = [
+        "| 版本 | 平均準確度 | 平均完整度 | 通過率 | 平均延遲 (秒) | P95 延遲 (秒) | 輸入 tokens | 輸出 tokens |",
+        "|---|---|---|---|---|---|---|---|"
+    ]
+    for s in summaries:
+        lines.append(
+            f"| {s['variant']} | {s['mean_accuracy']:.3f} | {s['mean_completeness']:.3f} | {s['pass_rate']:.1%} "
+            f"| {s['mean_latency']:.2f} | {s['p95_latency']:.2f} | {s['input_tokens']} | {s['output_tokens']} |"
+        )
+    return "\n".join(lines)
+
+async def main():
+    """
+    主執行流程：以多個候選 Prompt 版本同時對測試集提問並評估，
+    各版本共用檢索結果與未變動階段的 LLM 呼叫，最後輸出各版本的分數、延遲與 token 用量比較表。
+    """
+    test_data = run_stage.load_test_dataset()
+    if not test_data:
+        return
+
+    variants = load_variants()
+    if len(variants) < 2:
+        print("⚠️ 警告：沒有可用的候選版本，將只執行基準版本。")
+
+    print("\n--- 正在初始化受測系統 (SOPQuerySystem) ---")
+    base_sut = run_stage.SOPQuerySystem()
+    if not base_sut.initialization_success:
+        print("❌ 受測系統初始化失敗，測試中止。")
+        return
+
+    # 所有版本共用同一份檢索快取與 LLM 呼叫快取；
+    # 某版本只改了第二階段時，第一階段的提取結果會直接沿用其他版本已發出的呼叫。
+    # 共用的呼叫會計入每個使用該結果的版本的 token 用量，因此各版本的用量等同於單獨執行時的用量，可以互相比較。
+    retrieval_cache = {}
+    llm_cache = {}
+    usage_callbacks = {}
+    variant_suts = {}
+    for name, overrides in variants.items():
+        usage_callbacks[name] = UsageMetadataCallbackHandler()
+        variant_suts[name] = base_sut.clone_with_prompts(
+            overrides, retrieval_cache=retrieval_cache, llm_cache=llm_cache, usage_callback=usage_callbacks[name]
+        )
+
+    # 不同版本產生完全相同的答案時，評估結果也直接共用
+    evaluation_cache = {}
+    async def evaluate_cached(test_result):
+        cache_key = (test_result["question"], test_result["actual_answer"])
+        if cache_key not in evaluation_cache:
+            evaluation_cache[cache_key] = asyncio.ensure_future(
+                evaluate_stage.evaluate_single_answer_async(base_sut.llm, test_result)
+            )
+        return await evaluation_cache[cache_key]
+
+    print(f"\n--- 開始 A/B 測試：{len(variants)} 個版本 × {len(test_data)} 個問題 ---")
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_QUERIES)
+    tasks = [
+        run_variant_query(name, variant_suts[name], qa_pair, semaphore, evaluate_cached)
+        for name in variants for qa_pair in test_data if qa_pair.get("question")
+    ]
+    try:
+        all_results = await asyncio.gather(*tasks)
+    finally:
+        # 各版本共用原始物件的檢索程序池，只需關閉 base_sut
+        base_sut.close()
+
+    summaries = []
+    for name in variants:
+        variant_results = [r for r in all_results if r["variant"] == name]
+        summaries.append(summarize_variant(name, variant_results, usage_callbacks[name]))
+    summaries.sort(key=lambda s: (s["pass_rate"], s["mean_accuracy"] + s["mean_completeness"]), reverse=True)
+
+    summary_table = format_summary_table(summaries)
+    print("\n========== Prompt A/B 測試結果 ==========")
+    print(summary_table)
+    print(f"(共發出 {len(llm_cache)} 次不重複的受測系統 LLM 呼叫、{len(evaluation_cache)} 次評估呼叫)")
+
+    try:
+        with open("prompt_ab_results.json", 'w', encoding='utf-8') as f:
+            json.dump({"summary": summaries, "variants": variants, "results": all_results}, f, ensure_ascii=False, indent=4)
+        with open("prompt_ab_report.md", 'w', encoding='utf-8') as f:
+            f.write("# Prompt A/B 測試報告\n\n" + summary_table + "\n")
+        print("\n🎉 A/B 測試完成！比較表已儲存至 'prompt_ab_report.md'，詳細結果已儲存至 'prompt_ab_results.json'")
+    except Exception as e:
+        print(f"❌ 儲存 A/B 測試結果時發生錯誤：{e}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,168 @@
+import os
+import io
+import sys
+import json
+import time
+import statistics
+import importlib
+import contextlib
+
+# 讓 Python 找到同資料夾的各階段腳本，以及上一層的 sut_system 模組
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from metrics import percentile
+
+# 各階段腳本的檔名以數字開頭，無法直接使用 import 語法，改用 importlib 引入
+run_stage = importlib.import_module("2_run_tests")
+
+# --- 設定區 ---
+K_VALUES = [1, 3, 5, 10]  # 要計算 recall@k 的 k 值
+OUTPUT_FILENAME = "retrieval_benchmark.json"
+WORKSHEETS = None         # 檢索的工作表範圍 (None 表示依受測系統的 ALLOWED_WORKSHEET_IDENTIFIERS，"all" 表示全部工作表)
+
+def build_rule_based_retriever(sut, worksheets=None):
+    """
+    建立預設的檢索器：使用受測系統的規則式關鍵字提取與區塊搜尋 (完全不呼叫 LLM)，worksheets 為搜尋的工作表範圍。
+    檢索器是一個函式，輸入問題、回傳依相關程度排序的工作表標題列表；
+    可替換成任何相同介面的函式，以比較不同的斷詞或檢索策略。
+    """
+    def retrieve(question):
+        keywords_data = sut._extract_keywords_rule_based(question)
+        if not keywords_data or not keywords_data.get("原料名稱"):
+            return []
+        return [section["title"] for section in sut._search_sections(keywords_data, worksheets)]
+    return retrieve
+
+def _recall_metrics(queries, k_values):
+    """計算一組問題的 recall@k、recall@全部與 MRR (沒有問題時回傳 None)。"""
+    total = len(queries)
+    if not total:
+        return None
+    return {
+        "queries": total,
+        "recall_at_k": {
+            str(k): sum(1 for q in queries if q["rank"] and q["rank"] <= k) / total for k in k_values
+        },
+        "recall_any": sum(1 for q in queries if q["rank"]) / total,
+        "mrr": sum(1 / q["rank"] for q in queries if q["rank"]) / total
+    }
+
+def benchmark_retrieval(qa_pairs, retriever, searchable_titles=None, k_values=K_VALUES):
+    """
+    對每組帶有來源區塊 (source_section) 的問答執行檢索，計算 recall@k、MRR、
+    每個問題命中的區塊數 (即第一階段 LLM 的呼叫次數) 與檢索延遲。
+    searchable_titles 為檢索器實際可搜尋的區塊標題；來源區塊不在其中的問題不可能被命中，
+    因此 recall 與 MRR 分別以「搜尋範圍內的問題」(in_scope，反映斷詞與搜尋品質) 與「全部問題」(overall) 計算。
+    """
+    per_query = []
+    skipped = 0
+    for qa_pair in qa_pairs:
+        question = qa_pair.get("question")
+        source_section = qa_pair.get("source_section")
+        if not question or not source_section:
+            skipped += 1
+            continue
+        # 受測系統的檢索函式會印出大量除錯訊息，基準測試時將其隱藏
+        with contextlib.redirect_stdout(io.StringIO()):
+            start_time = time.perf_counter()
+            retrieved_titles = retriever(question)
+            latency = time.perf_counter() - start_time
+        rank = retrieved_titles.index(source_section) + 1 if source_section in retrieved_titles else None
+        per_query.append({
+            "question": question,
+            "source_section": source_section,
+            "in_search_scope": searchable_titles is None or source_section in searchable_titles,
+            "rank": rank,
+            "fan_out": len(retrieved_titles),
+            "latency_ms": latency * 1000
+        })
+
+    total = len(per_query)
+    if not total:
+        return {"queries": 0, "skipped_without_source": skipped}, per_query
+
+    fan_outs = [q["fan_out"] for q in per_query]
+    latencies = [q["latency_ms"] for q in per_query]
+    summary = {
+        "queries": total,
+        "skipped_without_source": skipped,
+        "out_of_search_scope": sum(1 for q in per_query if not q["in_search_scope"]),
+        "no_section_matched": sum(1 for f in fan_outs if f == 0),
+        "in_scope": _recall_metrics([q for q in per_query if q["in_search_scope"]], k_values),
+        "overall": _recall_metrics(per_query, k_values),
+        "fan_out": {
+            "mean": statistics.mean(fan_outs),
+            "p50": percentile(fan_outs, 50),
+            "p95": percentile(fan_outs, 95),
+            "max": max(fan_outs)
+        },
+        "latency_ms": {
+            "mean": statistics.mean(latencies),
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "total": sum(latencies)
+        }
+    }
+    return summary, per_query
+
+def _print_recall(label, metrics):
+    print(f"{label}:")
+    for k, recall in metrics["recall_at_k"].items():
+        print(f"   recall@{k}: {recall:.1%}")
+    print(f"   recall@全部: {metrics['recall_any']:.1%}   MRR: {metrics['mrr']:.3f}")
+
+def print_summary(summary):
+    """將基準測試摘要輸出到終端機。"""
+    print("\n========== 檢索基準測試結果 ==========")
+    print(f"問題數: {summary['queries']} (略過無來源區塊的問題 {summary['skipped_without_source']} 個)")
+    if not summary["queries"]:
+        return
+    print(f"來源區塊不在搜尋範圍內: {summary['out_of_search_scope']} 個；完全沒有命中任何區塊: {summary['no_section_matched']} 個")
+    if summary["in_scope"]:
+        _print_recall(f"搜尋範圍內的問題 ({summary['in_scope']['queries']} 個，反映斷詞與搜尋品質)", summary["in_scope"])
+    else:
+        print("所有問題的來源區塊都不在搜尋範圍內，無法評估搜尋範圍內的 recall。")
+    _print_recall(f"全部問題 ({summary['overall']['queries']} 個，含搜尋範圍外的問題)", summary["overall"])
+    fan_out = summary["fan_out"]
+    print(f"每題命中區塊數 (LLM 呼叫數): 平均 {fan_out['mean']:.2f} / P50 {fan_out['p50']} / P95 {fan_out['p95']} / 最大 {fan_out['max']}")
+    latency = summary["latency_ms"]
+    print(f"檢索延遲 (毫秒): 平均 {latency['mean']:.2f} / P50 {latency['p50']:.2f} / P95 {latency['p95']:.2f} / P99 {latency['p99']:.2f} (總計 {latency['total']:.0f})")
+    print("======================================")
+
+def main():
+    """主執行流程：以僅檢索模式載入受測系統，對整份測試集執行檢索基準測試 (不需任何 API 呼叫)。"""
+    test_data = run_stage.load_test_dataset()
+    if not test_data:
+        return
+
+    print("\n--- 正在初始化受測系統 (僅檢索模式) ---")
+    sut = run_stage.SOPQuerySystem(retrieval_only=True)
+    if not sut.initialization_success:
+        print("❌ 受測系統初始化失敗，測試中止。")
+        return
+
+    retriever = build_rule_based_retriever(sut, WORKSHEETS)
+    # 預先執行一次，讓 jieba 載入詞典的時間不計入檢索延遲
+    with contextlib.redirect_stdout(io.StringIO()):
+        retriever(test_data[0].get("question") or "暖機")
+
+    searchable_indexes = sut.default_worksheets if WORKSHEETS is None else sut._resolve_worksheets(WORKSHEETS)
+    searchable_titles = {sut.all_sections[i]["title"] for i in searchable_indexes}
+    try:
+        summary, per_query = benchmark_retrieval(test_data, retriever, searchable_titles)
+    finally:
+        # 基準測試直接在主程序中檢索；若依設定建立了檢索程序池，仍需釋放
+        sut.close()
+    print_summary(summary)
+
+    try:
+        with open(OUTPUT_FILENAME, 'w', encoding='utf-8') as f:
+            json.dump({"summary": summary, "queries": per_query}, f, ensure_ascii=False, indent=4)
+        print(f"\n✅ 詳細結果已儲存至 '{OUTPUT_FILENAME}'")
+    except Exception as e:
+        print(f"❌ 儲存基準測試結果時發生錯誤：{e}")
+
+if __name__ == "__main__":
+    main()
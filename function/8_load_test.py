@@ -0,0 +1,327 @@
+import os
+import sys
+import json
+import math
+import time
+import random
+import asyncio
+import importlib
+import statistics
+import contextlib
+from typing import Optional
+
+# --- 必要的套件引入 ---
+import psutil
+from pydantic import PrivateAttr
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+# 讓 Python 找到同資料夾的各階段腳本，以及上一層的 sut_system 模組
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from metrics import percentile
+
+# 各階段腳本的檔名以數字開頭，無法直接使用 import 語法，改用 importlib 引入
+run_stage = importlib.import_module("2_run_tests")
+
+# ==============================================================================
+# --- 設定區 ---
+# ==============================================================================
+TARGET_RPS = 2.0                # 目標到達率 (每秒查詢數)，到達間隔服從指數分佈 (Poisson 到達)
+DURATION_SECONDS = 60           # 送出查詢的持續時間 (秒)；長時間浸泡測試可設為數小時
+MAX_IN_FLIGHT = 32              # 同時處理中的查詢上限，超過時新到達的查詢須排隊 (排隊時間計入延遲)
+REQUEST_TIMEOUT_SECONDS = 60    # 單一查詢從到達起算的逾時時間 (包含排隊)
+SAMPLE_INTERVAL_SECONDS = 5     # 記錄吞吐量與記憶體用量的取樣間隔 (秒)
+RANDOM_SEED = 42                # 固定亂數種子，讓到達時間與問題順序可重現
+
+# 問題來源：預設使用 test_dataset.json；若指定正式環境的查詢記錄檔，則改為重播其中的問題。
+# 記錄檔每行一筆，可以是純文字問題，或含有 "question" / "message" 欄位的 JSON 物件。
+QUERY_LOG_FILE = None
+
+# 以本地模擬 LLM 取代 OpenAI，可在離線狀態下規劃容量 (不產生任何 API 費用)
+USE_SIMULATED_LLM = True
+SIMULATED_LATENCY_MEDIAN_SECONDS = 1.5  # 模擬的單次 LLM 呼叫延遲中位數
+SIMULATED_LATENCY_SIGMA = 0.5           # 延遲的對數常態分佈參數 (越大長尾越明顯)
+SIMULATED_ERROR_RATE = 0.01             # 模擬的 LLM 呼叫失敗機率
+
+OUTPUT_FILENAME = "load_test_results.json"
+
+class SimulatedChatModel(BaseChatModel):
+    """
+    用於負載測試的本地模擬 LLM：每次呼叫等待一段服從對數常態分佈的延遲後回傳固定文字，
+    並以 error_rate 的機率拋出例外，模擬速率限制或網路錯誤。
+    """
+    latency_median: float = SIMULATED_LATENCY_MEDIAN_SECONDS
+    latency_sigma: float = SIMULATED_LATENCY_SIGMA
+    error_rate: float = SIMULATED_ERROR_RATE
+    response_text: str = "1. 模擬的 SOP 內容片段，供負載測試使用。"
+    seed: Optional[int] = None
+    _rng: random.Random = PrivateAttr(default_factory=random.Random)
+
+    def model_post_init(self, __context):
+        super().model_post_init(__context)
+        self._rng.seed(self.seed)
+
+    @property
+    def _llm_type(self):
+        return "simulated-chat-model"
+
+    def _sample_call(self):
+        """抽樣本次呼叫的延遲，並決定是否失敗。"""
+        latency = self._rng.lognormvariate(math.log(self.latency_median), self.latency_sigma)
+        return latency, self._rng.random() < self.error_rate
+
+    def _result(self, failed):
+        if failed:
+            raise RuntimeError("模擬的 LLM 呼叫失敗")
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.response_text))])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        latency, failed = self._sample_call()
+        time.sleep(latency)
+        return self._result(failed)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        latency, failed = self._sample_call()
+        await asyncio.sleep(latency)
+        return self._result(failed)
+
+def load_questions(query_log_file=QUERY_LOG_FILE):
+    """讀取要重播的問題：指定了查詢記錄檔時從記錄檔讀取，否則使用 test_dataset.json 中的問題。"""
+    if not query_log_file:
+        test_data = run_stage.load_test_dataset() or []
+        return [qa_pair["question"] for qa_pair in test_data if qa_pair.get("question")]
+
+    questions = []
+    try:
+        with open(query_log_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    record = line
+                if isinstance(record, dict):
+                    record = record.get("question") or record.get("message")
+                if isinstance(record, str) and record.strip():
+                    questions.append(record.strip())
+    except FileNotFoundError:
+        print(f"❌ 錯誤：找不到查詢記錄檔 '{query_log_file}'。")
+        return []
+    print(f"✅ 從 '{query_log_file}' 載入 {len(questions)} 筆查詢。")
+    return questions
+
+def _distribution(values):
+    """將一組秒數轉為毫秒的統計摘要。"""
+    values_ms = [value * 1000 for value in values]
+    if not values_ms:
+        return {}
+    return {
+        "mean": statistics.mean(values_ms),
+        "p50": percentile(values_ms, 50),
+        "p95": percentile(values_ms, 95),
+        "p99": percentile(values_ms, 99),
+        "max": max(values_ms)
+    }
+
+def _memory_mb(process):
+    """目前程序 (含檢索子程序) 的常駐記憶體用量 (MB)。"""
+    rss = process.memory_info().rss
+    for child in process.children(recursive=True):
+        with contextlib.suppress(psutil.Error):
+            rss += child.memory_info().rss
+    return rss / (1024 * 1024)
+
+async def run_load_test(sut, questions, target_rps=TARGET_RPS, duration_seconds=DURATION_SECONDS,
+                        max_in_flight=MAX_IN_FLIGHT, request_timeout=REQUEST_TIMEOUT_SECONDS,
+                        sample_interval=SAMPLE_INTERVAL_SECONDS, seed=RANDOM_SEED):
+    """
+    開放迴路 (open-loop) 負載測試：依 Poisson 到達時間送出查詢，不等待前一個查詢完成。
+    回傳 (每筆查詢的紀錄, 依時間取樣的吞吐量與記憶體紀錄)。
+    每筆紀錄的 queue_delay 為等待處理名額的時間、latency 為從到達到完成的總時間；
+    在佇列中等到逾時仍未取得名額的查詢，queue_delay 記為整段等待時間 (實際排隊時間只會更長)，並標記 timed_out_in_queue。
+    """
+    rng = random.Random(seed)
+    semaphore = asyncio.Semaphore(max_in_flight)
+    process = psutil.Process()
+    records = []
+    timeline = []
+    in_flight_tasks = set()
+    processing_count = 0
+    start_time = time.monotonic()
+
+    async def handle_query(request_id, question, arrival_time):
+        record = {"id": request_id, "question": question, "arrival": arrival_time - start_time,
+                  "queue_delay": None, "latency": None, "status": None, "extraction_errors": 0,
+                  "timed_out_in_queue": False}
+
+        async def acquire_and_query():
+            nonlocal processing_count
+            async with semaphore:
+                record["queue_delay"] = time.monotonic() - arrival_time
+                processing_count += 1
+                try:
+                    return await sut.process_query(question, return_trace=True)
+                finally:
+                    processing_count -= 1
+
+        try:
+            result = await asyncio.wait_for(acquire_and_query(), timeout=request_timeout)
+            trace = result["trace"]
+            record["extraction_errors"] = sum(1 for extraction in trace["extractions"] if extraction.get("error"))
+            record["status"] = "error" if trace["error"] else "ok"
+        except asyncio.TimeoutError:
+            record["status"] = "timeout"
+            if record["queue_delay"] is None:
+                record["queue_delay"] = time.monotonic() - arrival_time
+                record["timed_out_in_queue"] = True
+        except Exception as e:
+            record["status"] = "error"
+            record["error"] = f"{type(e).__name__}: {e}"
+        record["latency"] = time.monotonic() - arrival_time
+        records.append(record)
+
+    async def sample_metrics():
+        while True:
+            await asyncio.sleep(sample_interval)
+            sample = {
+                "elapsed": time.monotonic() - start_time,
+                "completed": len(records),
+                "in_flight": processing_count,
+                "outstanding": len(in_flight_tasks),
+                "memory_mb": _memory_mb(process)
+            }
+            timeline.append(sample)
+            print(f"   [{sample['elapsed']:6.0f}s] 已完成 {sample['completed']} / 處理中 {sample['in_flight']} / "
+                  f"未完成 {sample['outstanding']} / 記憶體 {sample['memory_mb']:.1f} MB", file=sys.__stdout__)
+
+    timeline.append({"elapsed": 0.0, "completed": 0, "in_flight": 0, "outstanding": 0, "memory_mb": _memory_mb(process)})
+    sampler = asyncio.create_task(sample_metrics())
+    next_arrival = start_time
+    request_id = 0
+    while True:
+        next_arrival += rng.expovariate(target_rps)
+        if next_arrival - start_time >= duration_seconds:
+            break
+        await asyncio.sleep(max(0.0, next_arrival - time.monotonic()))
+        # 以預定的到達時間計算延遲，避免事件迴圈忙碌造成的送出延遲被隱藏 (coordinated omission)
+        task = asyncio.create_task(handle_query(request_id, rng.choice(questions), next_arrival))
+        in_flight_tasks.add(task)
+        task.add_done_callback(in_flight_tasks.discard)
+        request_id += 1
+
+    if in_flight_tasks:
+        await asyncio.gather(*in_flight_tasks)
+    sampler.cancel()
+    timeline.append({"elapsed": time.monotonic() - start_time, "completed": len(records),
+                     "in_flight": 0, "outstanding": 0, "memory_mb": _memory_mb(process)})
+    return records, timeline
+
+def summarize_load_test(records, timeline, duration_seconds=DURATION_SECONDS):
+    """
+    彙整負載測試結果：吞吐量、排隊時間、延遲百分位數、錯誤與逾時比例，以及記憶體變化。
+    排隊時間包含在佇列中逾時的查詢 (以等待到逾時的時間計)，其筆數另外列在 timeouts_in_queue。
+    """
+    total = len(records)
+    if not total:
+        return {"arrivals": 0}
+    ok_records = [r for r in records if r["status"] == "ok"]
+    wall_time = timeline[-1]["elapsed"]
+    memory = [sample["memory_mb"] for sample in timeline]
+    return {
+        "arrivals": total,
+        "offered_rps": total / duration_seconds,
+        "achieved_rps": len(ok_records) / wall_time if wall_time else 0.0,
+        "wall_time_seconds": wall_time,
+        "ok": len(ok_records),
+        "errors": sum(1 for r in records if r["status"] == "error"),
+        "timeouts": sum(1 for r in records if r["status"] == "timeout"),
+        "error_rate": sum(1 for r in records if r["status"] == "error") / total,
+        "timeout_rate": sum(1 for r in records if r["status"] == "timeout") / total,
+        "timeouts_in_queue": sum(1 for r in records if r["timed_out_in_queue"]),
+        "queries_with_extraction_errors": sum(1 for r in records if r["extraction_errors"]),
+        "queue_delay_ms": _distribution([r["queue_delay"] for r in records if r["queue_delay"] is not None]),
+        "latency_ms": _distribution([r["latency"] for r in ok_records]),
+        "memory_mb": {
+            "start": memory[0],
+            "end": memory[-1],
+            "peak": max(memory),
+            "growth": memory[-1] - memory[0]
+        }
+    }
+
+def print_summary(summary):
+    """將負載測試摘要輸出到終端機。"""
+    print("\n========== 負載測試結果 ==========")
+    if not summary["arrivals"]:
+        print("沒有送出任何查詢。")
+        return
+    print(f"送出查詢: {summary['arrivals']} 個 (目標到達率 {summary['offered_rps']:.2f} 次/秒)，"
+          f"成功完成吞吐量: {summary['achieved_rps']:.2f} 次/秒 (總耗時 {summary['wall_time_seconds']:.1f} 秒)")
+    print(f"成功: {summary['ok']} / 錯誤: {summary['errors']} ({summary['error_rate']:.1%}) / "
+          f"逾時: {summary['timeouts']} ({summary['timeout_rate']:.1%}，其中 {summary['timeouts_in_queue']} 個在排隊時逾時)；"
+          f"部分區塊提取失敗的查詢: {summary['queries_with_extraction_errors']}")
+    for label, key in (("排隊時間", "queue_delay_ms"), ("端到端延遲", "latency_ms")):
+        stats = summary[key]
+        if stats:
+            print(f"{label} (毫秒): 平均 {stats['mean']:.0f} / P50 {stats['p50']:.0f} / P95 {stats['p95']:.0f} / "
+                  f"P99 {stats['p99']:.0f} / 最大 {stats['max']:.0f}")
+    memory = summary["memory_mb"]
+    print(f"記憶體 (MB): 開始 {memory['start']:.1f} / 結束 {memory['end']:.1f} / 峰值 {memory['peak']:.1f} / 增加 {memory['growth']:+.1f}")
+    print("==================================")
+
+async def main():
+    """主執行流程：載入問題與受測系統，以設定的到達率執行負載測試並儲存結果。"""
+    questions = load_questions()
+    if not questions:
+        print("❌ 沒有可用於負載測試的問題，測試中止。")
+        return
+
+    print("\n--- 正在初始化受測系統 (SOPQuerySystem) ---")
+    if USE_SIMULATED_LLM:
+        print(f"使用本地模擬 LLM (延遲中位數 {SIMULATED_LATENCY_MEDIAN_SECONDS} 秒，失敗率 {SIMULATED_ERROR_RATE:.1%})。")
+        sut = run_stage.SOPQuerySystem(llm=SimulatedChatModel(seed=RANDOM_SEED))
+    else:
+        sut = run_stage.SOPQuerySystem()
+    if not sut.initialization_success:
+        print("❌ 受測系統初始化失敗，測試中止。")
+        return
+
+    print(f"\n--- 開始負載測試：{TARGET_RPS} 次/秒，持續 {DURATION_SECONDS} 秒，同時處理上限 {MAX_IN_FLIGHT} ---")
+    # 受測系統每個查詢都會印出大量除錯訊息，測試期間將其導向 os.devnull (長時間測試時也不會累積在記憶體中)
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            # 預先執行一次檢索，讓 jieba 載入詞典的時間不計入測試結果
+            await sut._retrieve_async(questions[0])
+            records, timeline = await run_load_test(sut, questions)
+    finally:
+        sut.close()
+
+    summary = summarize_load_test(records, timeline)
+    print_summary(summary)
+
+    config = {
+        "target_rps": TARGET_RPS,
+        "duration_seconds": DURATION_SECONDS,
+        "max_in_flight": MAX_IN_FLIGHT,
+        "request_timeout_seconds": REQUEST_TIMEOUT_SECONDS,
+        "query_source": QUERY_LOG_FILE or "test_dataset.json",
+        "simulated_llm": {
+            "latency_median_seconds": SIMULATED_LATENCY_MEDIAN_SECONDS,
+            "latency_sigma": SIMULATED_LATENCY_SIGMA,
+            "error_rate": SIMULATED_ERROR_RATE
+        } if USE_SIMULATED_LLM else None
+    }
+    try:
+        with open(OUTPUT_FILENAME, 'w', encoding='utf-8') as f:
+            json.dump({"config": config, "summary": summary, "timeline": timeline, "queries": records}, f, ensure_ascii=False, indent=4)
+        print(f"\n✅ 詳細結果已儲存至 '{OUTPUT_FILENAME}'")
+    except Exception as e:
+        print(f"❌ 儲存負載測試結果時發生錯誤：{e}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,9 @@
+import math
+
+def percentile(values, percent):
+    """計算百分位數 (最近秩法)；供各測試腳本彙整延遲等統計數據時共用。"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(percent / 100 * len(ordered)))
+    return ordered[rank - 1]